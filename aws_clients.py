@@ -0,0 +1,38 @@
+"""
+boto3 クライアントを初回利用時に作成する
+
+boto3 と botocore はクライアント作成時に読み込み、ハンドラの読み込みを軽くする。
+例外クラスも aws_clients.ClientError のように参照した時点で読み込む。
+"""
+
+
+# keyword arguments of botocore.config.Config
+CLIENT_CONFIG = {"connect_timeout": 3,
+                 "read_timeout": 10,
+                 "retries": {"max_attempts": 5, "mode": "adaptive"},
+                 "max_pool_connections": 10}
+
+def create_client(service: str, region: str=None, retries: dict=None):
+    """create boto3 client importing boto3 on first use
+
+    Args:
+        service (str): service name. e.g. "cloudwatch"
+        region (str, optional): region name. Defaults to lambda region.
+        retries (dict, optional): retries of botocore config. Defaults to CLIENT_CONFIG.
+
+    Returns:
+        boto3.client: client object
+    """
+    import boto3
+    from botocore.config import Config
+    config = dict(CLIENT_CONFIG)
+    if retries is not None:
+        config["retries"] = retries
+    return boto3.client(service, region_name=region, config=Config(**config))
+
+def __getattr__(name: str):
+    # except clauses evaluate exception classes only when an exception is raised
+    if name in ("BotoCoreError", "ClientError", "ConnectionError", "HTTPClientError"):
+        from botocore import exceptions
+        return getattr(exceptions, name)
+    raise AttributeError("module {0} has no attribute {1}".format(__name__, name))
@@ -0,0 +1,611 @@
+import os
+import sys
+import json
+import time
+import logging
+import statistics
+import collections
+import subprocess
+import argparse
+import tracemalloc
+import contextlib
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import write_scheduler
+import dashboard_model
+from local_sqs import LocalSQS
+from local_cloudwatch import LocalCloudWatch
+import drain_cwmetrics_ebs
+import register_cwmetrics_ebs
+import dashboard_io
+import register_cwmetrics_ebs_viasqs
+
+"""
+ボリューム登録処理のベンチマーク
+
+CreateVolume イベントを LocalCloudWatch に対して各ハンドラで再生し、
+events/sec, ハンドラのレイテンシ (p50/p99), イベントあたりの API 呼び出し数,
+ピークメモリを計測する。
+import モードではハンドラのモジュールの読み込み時間 (コールドスタートの初期化) を計測する。
+scheduler モードでは API の上限を超える並列書き込みを, スケジューラ経由と
+スロットリング時に即時再試行する場合とで比較する。
+parse モードでは大きな DashboardBody へのボリューム追加を, 全体を読み込む場合と
+ウィジェットを JSON の断片のまま扱う場合とで比較する。
+concurrency モードでは別々のキャッシュを持つ SQS ハンドラを並行に動かし,
+ボリュームが欠落や重複なく登録されることを確認する。
+"""
+
+
+DBOARD_NAME = "bench"
+# invocations assumed to run at once in contention()
+CONCURRENCY = 10
+IMPORT_MODULES = ("dashboard_model", "dashboard_io", "register_cwmetrics_ebs",
+                  "register_cwmetrics_ebs_viasqs", "drain_cwmetrics_ebs")
+# imports a module in a fresh interpreter and prints seconds and modules loaded
+IMPORT_SCRIPT = """
+import sys, json, time, importlib
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "modules": len(sys.modules),
+                  "aws": sorted({name.split(".")[0] for name in sys.modules} & {"boto3", "botocore"})}))
+"""
+
+def synthetic_events(count: int, start: int=0):
+    """generate CreateVolume events of EventBridge
+
+    Args:
+        count (int): number of events
+        start (int, optional): first number of VolumeId
+
+    Returns:
+        list: events
+    """
+    return [{"detail-type": "EBS Volume Notification",
+             "source": "aws.ec2",
+             "region": "ap-northeast-1",
+             "resources": ["arn:aws:ec2:ap-northeast-1:000000000000:volume/vol-{0:017x}".format(i)],
+             "detail": {"event": "createVolume", "result": "available"}}
+            for i in range(start, start + count)]
+
+def load_events(path: str):
+    """load events from JSONL file
+
+    Each line is an EventBridge event or SQS record having it as body.
+
+    Args:
+        path (str): file path
+
+    Returns:
+        list: events
+    """
+    events = list()
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if "body" in event:
+                event = json.loads(event["body"])
+            events.append(event)
+    return events
+
+def sqs_invocations(events: list, batch_size: int):
+    """pack events into SQS events delivered to lambda
+
+    Args:
+        events (list): EventBridge events
+        batch_size (int): number of records per invocation
+
+    Returns:
+        list: SQS events
+    """
+    records = [{"messageId": "msg-{0}".format(i), "body": json.dumps(event)}
+               for i, event in enumerate(events)]
+    return [{"Records": records[i:i + batch_size]}
+            for i in range(0, len(records), batch_size)]
+
+def ebs_invocations(events: list):
+    """set dashboard name to events delivered to lambda
+
+    Args:
+        events (list): EventBridge events
+
+    Returns:
+        list: events
+    """
+    return [dict(event, params={"dboard_name": DBOARD_NAME}) for event in events]
+
+def percentile(values: list, p: float):
+    """percentile with nearest-rank method
+
+    Args:
+        values (list): sorted values
+        p (float): percentile 0-100
+
+    Returns:
+        float: value
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def contention(written: list, concurrency: int=CONCURRENCY):
+    """number of writers contending on the hottest dashboard
+
+    Invocations replayed in order are grouped by concurrency
+    as if invocations of a group ran at once.
+
+    Args:
+        written (list): [set of dashboard names put] per invocation
+        concurrency (int, optional): number of invocations running at once
+
+    Returns:
+        float: average of max number of invocations putting a dashboard in a group
+    """
+    hottest = list()
+    for i in range(0, len(written), concurrency):
+        writers = collections.Counter([name for names in written[i:i + concurrency] for name in names])
+        hottest.append(max(writers.values(), default=0))
+    return round(statistics.mean(hottest), 2) if hottest else 0.0
+
+def run(handler, invocations: list, client: LocalCloudWatch, nevents: int,
+        concurrency: int=CONCURRENCY):
+    """invoke handler and measure it
+
+    Args:
+        handler: lambda handler
+        invocations (list): events delivered to lambda
+        client (LocalCloudWatch): cloudwatch emulator used by handler
+        nevents (int): number of volume events in invocations
+        concurrency (int, optional): invocations assumed to run at once. see contention()
+
+    Returns:
+        dict: measurements
+    """
+    latencies = list()
+    written = list()
+    errors = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for invocation in invocations:
+            t = time.perf_counter()
+            puts = dict(client.puts)
+            try:
+                res = handler(invocation, None)
+                errors += len(res.get("batchItemFailures", []))
+            except Exception as e:
+                logging.getLogger().debug("handler failed: {0}".format(e))
+                errors += len(invocation.get("Records", [invocation]))
+            latencies.append(time.perf_counter() - t)
+            written.append({name for name, count in client.puts.items() if puts.get(name) != count})
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies.sort()
+    return {"events": nevents,
+            "invocations": len(invocations),
+            "events_per_sec": round(nevents / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "api_calls_per_event": round(sum(client.calls.values()) / nevents, 3) if nevents else 0.0,
+            "api_calls": dict(client.calls),
+            "throttled": sum(client.throttled.values()),
+            "failed_events": errors,
+            "peak_memory_kb": round(peak / 1024, 1),
+            "dashboards": len(client.dashboards),
+            "hot_dashboard_writers": contention(written, concurrency)}
+
+def bench_sqs(events: list, batch_size: int=10, latency: float=0.0,
+              throttle_rate: float=0.0,
+              verify_delay: float=dashboard_io.PUT_VERIFY_DELAY):
+    """benchmark lambda_handler of register_cwmetrics_ebs_viasqs
+
+    Args:
+        events (list): EventBridge events
+        batch_size (int, optional): number of records per invocation
+        latency (float, optional): seconds of latency per API call
+        throttle_rate (float, optional): probability of throttling
+        verify_delay (float, optional): PUT_VERIFY_DELAY used in benchmark
+
+    Returns:
+        dict: measurements
+    """
+    client = LocalCloudWatch(latency=latency, throttle_rate=throttle_rate)
+    os.environ['DBOARD_PREFIX'] = DBOARD_NAME
+    dashboard_io.PUT_VERIFY_DELAY = verify_delay
+    dashboard_io.cwclients[None] = client
+    dashboard_io.dashboard_cache.clear()
+    dashboard_io.shard_index.clear()
+    dashboard_io.route_index.clear()
+    dashboard_io.dedupe_stores.clear()
+    dashboard_io.scanned_prefixes.clear()
+    return run(register_cwmetrics_ebs_viasqs.lambda_handler,
+               sqs_invocations(events, batch_size), client, len(events))
+
+def bench_ebs(events: list, latency: float=0.0, throttle_rate: float=0.0):
+    """benchmark lambda_handler of register_cwmetrics_ebs
+
+    Args:
+        events (list): EventBridge events
+        latency (float, optional): seconds of latency per API call
+        throttle_rate (float, optional): probability of throttling
+
+    Returns:
+        dict: measurements
+    """
+    # all volumes are registered to one dashboard without rollover
+    client = LocalCloudWatch(latency=latency, throttle_rate=throttle_rate,
+                             enforce_limits=False)
+    client.put_dashboard(DashboardName=DBOARD_NAME,
+                         DashboardBody=json.dumps({"widgets": []}))
+    client.calls.clear()
+    register_cwmetrics_ebs.cwclients[None] = client
+    register_cwmetrics_ebs.dedupe_stores.clear()
+    return run(register_cwmetrics_ebs.lambda_handler,
+               ebs_invocations(events), client, len(events))
+
+def bench_drain(events: list, window: float=1.0, max_messages: int=5000,
+                latency: float=0.0, throttle_rate: float=0.0,
+                verify_delay: float=dashboard_io.PUT_VERIFY_DELAY):
+    """benchmark queue drainer of drain_cwmetrics_ebs
+
+    All events are sent to LocalSQS before draining.
+
+    Args:
+        events (list): EventBridge events
+        window (float, optional): seconds to coalesce events
+        max_messages (int, optional): number of messages per window
+        latency (float, optional): seconds of latency per API call
+        throttle_rate (float, optional): probability of throttling
+        verify_delay (float, optional): PUT_VERIFY_DELAY used in benchmark
+
+    Returns:
+        dict: measurements
+    """
+    client = LocalCloudWatch(latency=latency, throttle_rate=throttle_rate)
+    sqs = LocalSQS(latency=latency)
+    for event in events:
+        sqs.send_message(QueueUrl=DBOARD_NAME, MessageBody=json.dumps(event))
+    dashboard_io.PUT_VERIFY_DELAY = verify_delay
+    dashboard_io.dashboard_cache.clear()
+    dashboard_io.shard_index.clear()
+    dashboard_io.route_index.clear()
+    dashboard_io.dedupe_stores.clear()
+    dashboard_io.scanned_prefixes.clear()
+    # the last empty receive should not wait in benchmark
+    drain_cwmetrics_ebs.RECEIVE_WAIT_TIME = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        total = drain_cwmetrics_ebs.run_worker(sqs, client, DBOARD_NAME, DBOARD_NAME,
+                                               window, max_messages)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"events": len(events),
+            "windows": total["windows"],
+            "events_per_sec": round(len(events) / elapsed, 1) if elapsed else 0.0,
+            "api_calls_per_event": round(sum(client.calls.values()) / len(events), 3) if events else 0.0,
+            "api_calls": dict(client.calls),
+            "sqs_calls": dict(sqs.calls),
+            "throttled": sum(client.throttled.values()),
+            "failed_events": len(total["failed"]),
+            "peak_memory_kb": round(peak / 1024, 1),
+            "dashboards": len(client.dashboards)}
+
+def load_instance(module, number: int):
+    """load a new copy of module which has its own globals
+
+    Args:
+        module (module): module loaded
+        number (int): instance number used in module name
+
+    Returns:
+        module: new module
+    """
+    spec = importlib.util.spec_from_file_location(
+        "{0}_{1}".format(module.__name__, number), module.__file__)
+    instance = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(instance)
+    return instance
+
+def handler_instance(client: LocalCloudWatch, number: int):
+    """load register_cwmetrics_ebs_viasqs as a new module like another Lambda container
+
+    dashboard_io is loaded again too, so caches of instances are not shared.
+
+    Args:
+        client (LocalCloudWatch): cloudwatch emulator shared by instances
+        number (int): instance number used in module name
+
+    Returns:
+        module: handler module having its own caches
+    """
+    io = load_instance(dashboard_io, number)
+    for name in ("PUT_VERIFY_DELAY", "SHARD_ROUTING", "SHARD_ROUTES"):
+        setattr(io, name, getattr(dashboard_io, name))
+    io.cwclients[None] = client
+    # the handler imports names from the new dashboard_io
+    sys.modules["dashboard_io"] = io
+    try:
+        return load_instance(register_cwmetrics_ebs_viasqs, number)
+    finally:
+        sys.modules["dashboard_io"] = dashboard_io
+
+def volume_counts(client: LocalCloudWatch):
+    """number of rows of each volume and metrics in dashboards
+
+    Args:
+        client (LocalCloudWatch): cloudwatch emulator
+
+    Returns:
+        collections.Counter: {(VolumeId, metrics name): number of rows}
+    """
+    counts = collections.Counter()
+    for name, dashboard in client.dashboards.items():
+        model = dashboard_io.parse_dashboard(name, dashboard["DashboardBody"])
+        for key, windex in model["reged_widgets"].items():
+            for widget in windex["widgets"]:
+                for rowvols, _ in dashboard_model.widget_series(
+                        widget, dashboard_model.search_volumes):
+                    counts.update([(volid, key) for volid in rowvols])
+    return counts
+
+def bench_concurrency(events: list, instances: int=4, batch_size: int=10, latency: float=0.0,
+                      verify_delay: float=dashboard_io.PUT_VERIFY_DELAY):
+    """run SQS handlers of separate caches at once and check registered volumes
+
+    Each instance handles its share of invocations twice as redelivered messages.
+    Redelivery to other instance is not replayed, because volumes registered
+    by other containers are found only by a shared DEDUPE_STORE.
+
+    Args:
+        events (list): EventBridge events
+        instances (int, optional): number of handlers running at once
+        batch_size (int, optional): number of records per invocation
+        latency (float, optional): seconds of latency per API call
+        verify_delay (float, optional): PUT_VERIFY_DELAY used in benchmark
+
+    Returns:
+        dict: measurements. lost_volumes and duplicated_volumes should be 0
+    """
+    client = LocalCloudWatch(latency=latency)
+    os.environ['DBOARD_PREFIX'] = DBOARD_NAME
+    dashboard_io.PUT_VERIFY_DELAY = verify_delay
+    handlers = [handler_instance(client, i) for i in range(instances)]
+    invocations = sqs_invocations(events, batch_size)
+
+    def invoke(i):
+        errors = 0
+        for invocation in invocations[i::instances] * 2:
+            errors += len(handlers[i].lambda_handler(invocation, None).get("batchItemFailures", []))
+        return errors
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=instances) as pool:
+            errors = sum(pool.map(invoke, range(instances)))
+    elapsed = time.perf_counter() - start
+    counts = volume_counts(client)
+    volids = {event["resources"][0].split("/")[1] for event in events}
+    keys = dashboard_model.METRICS_TEMPLATE.keys()
+    return {"events": len(events),
+            "instances": instances,
+            "events_per_sec": round(len(events) * 2 / elapsed, 1) if elapsed else 0.0,
+            "api_calls": dict(client.calls),
+            "failed_events": errors,
+            "lost_volumes": len([volid for volid in volids
+                                 if any(counts[(volid, key)] == 0 for key in keys)]),
+            "duplicated_volumes": len({volid for (volid, key), count in counts.items() if count > 1}),
+            "dashboards": len(client.dashboards)}
+
+def bench_import(modules: tuple=IMPORT_MODULES, repeat: int=5):
+    """benchmark import time of handler modules
+
+    Each module is imported in a new python process as Lambda init does.
+
+    Args:
+        modules (tuple, optional): module names
+        repeat (int, optional): number of processes per module
+
+    Returns:
+        dict: measurements per module
+    """
+    results = dict()
+    for module in modules:
+        samples = list()
+        for _ in range(repeat):
+            proc = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT, module],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True, check=True)
+            samples.append(json.loads(proc.stdout))
+        results[module] = {"import_ms_p50": round(statistics.median(
+                               [sample["seconds"] for sample in samples]) * 1000, 2),
+                           "import_ms_max": round(max(
+                               [sample["seconds"] for sample in samples]) * 1000, 2),
+                           "modules_loaded": samples[-1]["modules"],
+                           "aws_modules": samples[-1]["aws"]}
+    return results
+
+def bench_scheduler(writes: int=200, threads: int=16, dashboards: int=4,
+                    max_tps: float=20.0, rate: float=20.0, latency: float=0.0):
+    """benchmark concurrent put_dashboard over the API ceiling
+
+    "direct" retries throttled puts at once like clients without backoff,
+    "scheduled" puts through write_scheduler.ScheduledClient.
+
+    Args:
+        writes (int, optional): number of puts
+        threads (int, optional): number of concurrent writers
+        dashboards (int, optional): number of dashboards written
+        max_tps (float, optional): calls per second of LocalCloudWatch
+        rate (float, optional): calls per second of scheduler
+        latency (float, optional): seconds of latency per API call
+
+    Returns:
+        dict: measurements per mode
+    """
+    results = dict()
+    for mode in ("direct", "scheduled"):
+        client = LocalCloudWatch(latency=latency, max_tps=max_tps, enforce_limits=False)
+        target = client
+        if mode == "scheduled":
+            target = write_scheduler.ScheduledClient(client, rate, rate)
+
+        def put(i):
+            body = json.dumps({"widgets": [], "version": i})
+            for attempt in range(write_scheduler.THROTTLE_RETRIES + 1):
+                try:
+                    target.put_dashboard(DashboardName="{0}_{1}".format(DBOARD_NAME, i % dashboards),
+                                         DashboardBody=body)
+                    return True
+                except Exception as e:
+                    if mode == "scheduled" or not write_scheduler.is_throttling(e):
+                        return False
+            return False
+
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                done = list(pool.map(put, range(writes)))
+        elapsed = time.perf_counter() - start
+        results[mode] = {"writes": writes,
+                         "writes_per_sec": round(sum(done) / elapsed, 1) if elapsed else 0.0,
+                         "failed_writes": done.count(False),
+                         "api_calls": dict(client.calls),
+                         "throttled": sum(client.throttled.values())}
+        if mode == "scheduled":
+            results[mode]["scheduler"] = target.summary()
+    return results
+
+def dashboard_body(volumes: int):
+    """create DashboardBody having metrics of volumes
+
+    Args:
+        volumes (int): number of volumes
+
+    Returns:
+        str: DashboardBody
+    """
+    per_widget = dashboard_model.MAX_METRICS // 2
+    widgets = list()
+    for key in dashboard_model.METRICS_TEMPLATE.keys():
+        for number, i in enumerate(range(0, volumes, per_widget)):
+            metrics = [{"DimensionName": key, "VolumeId": "vol-{0:017x}".format(j)}
+                       for j in range(i, min(volumes, i + per_widget))]
+            widgets.append(dashboard_model.create_widget(
+                dashboard_model.widget_title(key, number + 1), metrics))
+    return dashboard_model.dumps_json({"widgets": widgets})
+
+def add_volume(dbody: str, partial: bool):
+    """parse DashboardBody, add a volume and serialize it as the handlers do
+
+    Args:
+        dbody (str): DashboardBody
+        partial (bool): keep untouched widgets as JSON fragments
+
+    Returns:
+        str: DashboardBody
+    """
+    if partial:
+        widgets = dashboard_model.split_widgets(dbody)
+    else:
+        widgets = json.loads(dbody)["widgets"]
+    others, reged_widgets, _ = dashboard_model.index_widgets(widgets)
+    for key, windex in reged_widgets.items():
+        dashboard_model.append_metrics(windex, key, [{"DimensionName": key, "VolumeId": "vol-new"}])
+        others.extend(windex["widgets"])
+    if partial:
+        return dashboard_model.dump_widgets(others)
+    return dashboard_model.dumps_json({"widgets": others})
+
+def bench_parse(volumes: int=2000, repeat: int=10):
+    """benchmark full parse and partial parse of large DashboardBody
+
+    Args:
+        volumes (int, optional): number of volumes in DashboardBody
+        repeat (int, optional): number of runs per mode
+
+    Returns:
+        dict: measurements per mode
+    """
+    dbody = dashboard_body(volumes)
+    results = {"body_bytes": len(dbody)}
+    for mode in ("full", "partial"):
+        latencies = list()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            add_volume(dbody, mode == "partial")
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        tracemalloc.start()
+        written = add_volume(dbody, mode == "partial")
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[mode] = {"p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                         "max_ms": round(latencies[-1] * 1000, 3),
+                         "peak_memory_kb": round(peak / 1024, 1),
+                         "body_bytes_out": len(written)}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EBS metrics registration handlers")
+    parser.add_argument("--events", help="JSONL file of events. synthetic events if omitted")
+    parser.add_argument("--count", type=int, default=1000, help="number of synthetic events")
+    parser.add_argument("--handler", choices=("sqs", "ebs", "drain", "import", "scheduler", "parse",
+                                              "concurrency", "both", "all"),
+                        default="both",
+                        help="both runs sqs and ebs, all runs every mode")
+    parser.add_argument("--batch-size", type=int, default=10, help="SQS batch size")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="probability of throttling")
+    parser.add_argument("--verify-delay", type=float, default=dashboard_io.PUT_VERIFY_DELAY,
+                        help="PUT_VERIFY_DELAY of SQS handler")
+    parser.add_argument("--shard-routing", choices=("fill", "hash", "tag"),
+                        default=dashboard_io.SHARD_ROUTING,
+                        help="SHARD_ROUTING of SQS handler and drainer")
+    parser.add_argument("--shard-routes", type=int, default=dashboard_io.SHARD_ROUTES,
+                        help="SHARD_ROUTES of SQS handler and drainer")
+    parser.add_argument("--window", type=float, default=1.0, help="seconds to coalesce events of drainer")
+    parser.add_argument("--max-messages", type=int, default=5000, help="messages per window of drainer")
+    parser.add_argument("--import-repeat", type=int, default=5, help="processes per module of import")
+    parser.add_argument("--writes", type=int, default=200, help="puts of scheduler")
+    parser.add_argument("--threads", type=int, default=16, help="concurrent writers of scheduler")
+    parser.add_argument("--max-tps", type=float, default=20.0, help="API calls per second of scheduler")
+    parser.add_argument("--scheduler-rate", type=float, default=20.0, help="token rate of scheduler")
+    parser.add_argument("--volumes", type=int, default=2000, help="volumes in DashboardBody of parse")
+    parser.add_argument("--parse-repeat", type=int, default=10, help="runs per mode of parse")
+    parser.add_argument("--instances", type=int, default=4, help="handlers running at once of concurrency")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    events = load_events(args.events) if args.events else synthetic_events(args.count)
+    dashboard_io.SHARD_ROUTING = args.shard_routing
+    dashboard_io.SHARD_ROUTES = args.shard_routes
+    results = dict()
+    if args.handler in ("sqs", "both", "all"):
+        results["sqs"] = bench_sqs(events, args.batch_size, args.latency,
+                                   args.throttle_rate, args.verify_delay)
+    if args.handler in ("ebs", "both", "all"):
+        results["ebs"] = bench_ebs(events, args.latency, args.throttle_rate)
+    if args.handler in ("drain", "all"):
+        results["drain"] = bench_drain(events, args.window, args.max_messages, args.latency,
+                                       args.throttle_rate, args.verify_delay)
+    if args.handler in ("import", "all"):
+        results["import"] = bench_import(repeat=args.import_repeat)
+    if args.handler in ("scheduler", "all"):
+        results["scheduler"] = bench_scheduler(args.writes, args.threads, max_tps=args.max_tps,
+                                               rate=args.scheduler_rate, latency=args.latency)
+    if args.handler in ("parse", "all"):
+        results["parse"] = bench_parse(args.volumes, args.parse_repeat)
+    if args.handler in ("concurrency", "all"):
+        results["concurrency"] = bench_concurrency(events, args.instances, args.batch_size,
+                                                   args.latency, args.verify_delay)
+    print(json.dumps(results, indent=2))
+    if "concurrency" in results and (results["concurrency"]["lost_volumes"]
+                                     or results["concurrency"]["duplicated_volumes"]):
+        sys.exit("volumes are lost or duplicated by concurrent handlers")
+
+if __name__ == "__main__":
+    main()
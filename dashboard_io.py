@@ -0,0 +1,1046 @@
+import re
+import os
+import time
+import random
+import hashlib
+import logging
+import aws_clients
+import dedupe_store
+import registrar_metrics
+import write_scheduler
+from concurrent.futures import ThreadPoolExecutor
+from dashboard_model import (WIDGET_TEMPLATE, MAX_METRICS_DBOARD, MAX_DBOARD_BYTES,
+                             WIDGET_MODE, WIDGET_MODE_SEARCH, init_dbinfos, gen_dbname,
+                             shard_number, shard_pattern, index_widgets, split_widgets,
+                             new_dashboard, registered_volumes, has_volumes, dashboard_locations,
+                             free_volumes, volumes_fit, is_limit_dashboard, pack_volumes,
+                             plan_volume, search_volumes, add_volume_to_dashboard,
+                             remove_volumes_from_dashboard, dump_dashboard)
+
+"""
+CloudWatch ダッシュボードのシャードを読み書きする
+
+シャードの一覧とインデックス, ダッシュボードモデルのキャッシュ,
+compare-and-swap での書き込みと検証, 逆引きインデックス, シャードグループへの振り分けを扱う。
+SQS のハンドラ, キューのドレイナー, 再構築コマンドから共通で使う。
+"""
+
+
+MIN_ROW_BYTES = 70
+MIN_SEARCH_ROW_BYTES = 150
+SHARD_INDEX_TTL = int(os.getenv('SHARD_INDEX_TTL', '300'))
+OPTIMISTIC_LOCK = os.getenv('OPTIMISTIC_LOCK', 'true').lower() == 'true'
+MAX_PUT_RETRIES = int(os.getenv('MAX_PUT_RETRIES', '5'))
+PUT_BACKOFF_BASE = float(os.getenv('PUT_BACKOFF_BASE', '0.1'))
+PUT_VERIFY_DELAY = float(os.getenv('PUT_VERIFY_DELAY', '0.5'))
+
+# dashboards of events in home region and account keep DBOARD_PREFIX
+HOME_REGION = os.getenv('HOME_REGION', os.getenv('AWS_REGION', WIDGET_TEMPLATE["properties"]["region"]))
+HOME_TARGET = (HOME_REGION, None)
+# "central" writes all dashboards in home region, "region" writes them in region of volumes
+ROUTING_CENTRAL = "central"
+ROUTING_REGION = "region"
+DASHBOARD_ROUTING = os.getenv('DASHBOARD_ROUTING', ROUTING_CENTRAL).lower()
+# "memory", "file:<path>" or "sqlite:<path>". see dedupe_store.open_store()
+DEDUPE_STORE = os.getenv('DEDUPE_STORE', 'memory')
+# read all shards once per container to know volumes registered before.
+# off by default because a cold container reads every shard. Volumes are still
+# found in shards loaded as candidates and in a persistent DEDUPE_STORE
+DEDUPE_SCAN = os.getenv('DEDUPE_SCAN', 'false').lower() == 'true'
+# "fill" places volumes to the first shard having free space,
+# "hash" routes volumes to shard groups by hash of VolumeId,
+# "tag" routes volumes to shard groups by a tag of the volume in the event
+SHARD_ROUTING_FILL = "fill"
+SHARD_ROUTING_HASH = "hash"
+SHARD_ROUTING_TAG = "tag"
+SHARD_ROUTING = os.getenv('SHARD_ROUTING', SHARD_ROUTING_FILL).lower()
+# number of shard groups of hash. volumes without the tag are routed by hash
+SHARD_ROUTES = int(os.getenv('SHARD_ROUTES', '8'))
+# tag key of tag routing. e.g. environment, service
+SHARD_TAG = os.getenv('SHARD_TAG', 'environment')
+# characters not allowed in dashboard names
+ROUTE_INVALID_CHARS = re.compile(r"[^A-Za-z0-9_-]")
+# max threads writing shard groups of an invocation at once
+SHARD_GROUP_WORKERS = int(os.getenv('SHARD_GROUP_WORKERS', '8'))
+
+# reused across warm invocations
+cwclients = dict()
+dashboard_cache = dict()
+shard_index = dict()
+route_index = dict()
+dedupe_stores = dict()
+scanned_prefixes = set()
+logger = logging.getLogger()
+
+def init_cwclient(region: str=None):
+    """initialize boto3 cloudwatch client
+
+    Client is created once per region and reused across warm invocations.
+    Dashboard APIs are rate limited by write_scheduler unless SCHEDULER_RATE is 0.
+
+    Args:
+        region (str, optional): region name. Defaults to lambda region.
+
+    Returns:
+        boto3.client: cloudwatch client object
+    """
+    if region not in cwclients:
+        cwclients[region] = write_scheduler.create_client("cloudwatch", region)
+    return cwclients[region]
+
+def init_dedupe_store(url: str=DEDUPE_STORE):
+    """initialize store of registered volumes
+
+    Store is created once per url and reused across warm invocations.
+
+    Args:
+        url (str, optional): store url. see dedupe_store.open_store()
+
+    Returns:
+        dedupe store
+    """
+    if url not in dedupe_stores:
+        dedupe_stores[url] = dedupe_store.open_store(url)
+    return dedupe_stores[url]
+
+def list_shards(client, dbname_prefix: str, pattern=None):
+    """list all dashboards having the prefix ordered by numeric suffix
+
+    Dashboards of other prefixes starting with the prefix are excluded.
+    e.g. dashboards of target_prefix() for other regions.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        pattern (re.Pattern, optional): pattern of dashboard names listed.
+            Defaults to shard_pattern(dbname_prefix).
+
+    Returns:
+        list: DashboardEntries of list_dashboards
+    """
+    if pattern is None:
+        pattern = shard_pattern(dbname_prefix)
+    entries = list()
+    params = {"DashboardNamePrefix": dbname_prefix}
+    while True:
+        with registrar_metrics.timer("ListDashboardsTime"):
+            res = client.list_dashboards(**params)
+        registrar_metrics.count("ListDashboardsCalls")
+        entries.extend([entry for entry in res['DashboardEntries']
+                        if pattern.match(entry['DashboardName'])])
+        if not res.get('NextToken'):
+            break
+        params['NextToken'] = res['NextToken']
+    return sorted(entries, key=lambda x: shard_number(x['DashboardName']))
+
+def target_prefix(dbname_prefix: str, target: tuple):
+    """dashboard name prefix of volumes of the target
+
+    Args:
+        dbname_prefix (str): dashboard name prefix of home target
+        target (tuple): (region, account). see volume_target()
+
+    Returns:
+        str: dashboard name prefix
+    """
+    region, account = target
+    if account:
+        return "{0}-{1}-{2}".format(dbname_prefix, account, region)
+    if region != HOME_REGION:
+        return "{0}-{1}".format(dbname_prefix, region)
+    return dbname_prefix
+
+def route_key(volid: str, tags: dict=None):
+    """key of the shard group which the volume is routed to
+
+    Hash of VolumeId is stable across invocations, so events of the volume
+    always go to the same shard group while SHARD_ROUTES is not changed.
+
+    Args:
+        volid (str): VolumeId
+        tags (dict, optional): tags of the volume. see volume_tags()
+
+    Returns:
+        str: route key. "h<number>" for hash and "<SHARD_TAG>-<value>" for tag
+    """
+    if SHARD_ROUTING == SHARD_ROUTING_TAG and tags and tags.get(SHARD_TAG):
+        return "{0}-{1}".format(SHARD_TAG, ROUTE_INVALID_CHARS.sub("_", str(tags[SHARD_TAG])))
+    digest = hashlib.sha1(volid.encode("utf-8")).digest()
+    return "h{0}".format(int.from_bytes(digest[:4], "big") % SHARD_ROUTES)
+
+def route_prefix(dbname_prefix: str, route: str):
+    """dashboard name prefix of the shard group
+
+    Shards of the group are named by gen_dbname() and init_dbinfos()
+    with this prefix as shards of dbname_prefix are.
+
+    Args:
+        dbname_prefix (str): dashboard name prefix of the target. see target_prefix()
+        route (str): route key. see route_key()
+
+    Returns:
+        str: dashboard name prefix. dbname_prefix itself with SHARD_ROUTING_FILL
+    """
+    if SHARD_ROUTING == SHARD_ROUTING_FILL:
+        return dbname_prefix
+    return "{0}-{1}".format(dbname_prefix, route)
+
+def route_pattern(dbname_prefix: str):
+    """pattern of shard names of all shard groups of the prefix
+
+    Args:
+        dbname_prefix (str): dashboard name prefix of the target
+
+    Returns:
+        re.Pattern: compiled pattern. group 1 is prefix of the shard group
+    """
+    return re.compile(r"({0}-(?:h\d+|{1}-[A-Za-z0-9_-]+))[ -]\d+$".format(
+        re.escape(dbname_prefix), re.escape(SHARD_TAG)))
+
+def shard_prefixes(client, dbname_prefix: str, refresh: bool=False):
+    """dashboard name prefixes of shards of the target
+
+    Prefixes listed by previous invocation are used without
+    list_dashboards until SHARD_INDEX_TTL expires.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix of the target
+        refresh (bool, optional): list shards even if prefixes are cached
+
+    Returns:
+        list: dbname_prefix and prefixes of shard groups written before.
+            only dbname_prefix with SHARD_ROUTING_FILL
+    """
+    if SHARD_ROUTING == SHARD_ROUTING_FILL:
+        return [dbname_prefix]
+    cached = route_index.get(dbname_prefix)
+    if not refresh and cached is not None and cached["expires"] > time.time():
+        return [dbname_prefix] + sorted(cached["routes"])
+    pattern = route_pattern(dbname_prefix)
+    routes = {pattern.match(entry['DashboardName']).group(1)
+              for entry in list_shards(client, dbname_prefix, pattern)}
+    route_index[dbname_prefix] = {"routes": routes, "expires": time.time() + SHARD_INDEX_TTL}
+    return [dbname_prefix] + sorted(routes)
+
+def update_route_index(dbname_prefix: str, prefixes: list):
+    """add prefixes of shard groups written to cached prefixes of the target
+
+    Args:
+        dbname_prefix (str): dashboard name prefix of the target
+        prefixes (list): dashboard name prefixes of shard groups
+    """
+    cached = route_index.get(dbname_prefix)
+    if cached is not None:
+        cached["routes"].update([prefix for prefix in prefixes if prefix != dbname_prefix])
+
+def group_routes(dbname_prefix: str, volumes: dict):
+    """group volumes by dashboard name prefix of its shard group
+
+    Args:
+        dbname_prefix (str): dashboard name prefix of the target
+        volumes (dict): {VolumeId: route key}
+
+    Returns:
+        dict: {dashboard name prefix: [VolumeId]}
+    """
+    groups = dict()
+    for volid, route in volumes.items():
+        groups.setdefault(route_prefix(dbname_prefix, route), list()).append(volid)
+    return groups
+
+def target_client(client, target: tuple):
+    """cloudwatch client which dashboards of the target are written with
+
+    Args:
+        client (boto3.client): cloudwatch client of home region
+        target (tuple): (region, account). see volume_target()
+
+    Returns:
+        boto3.client: cloudwatch client
+    """
+    if DASHBOARD_ROUTING == ROUTING_REGION and target[0] != HOME_REGION:
+        return init_cwclient(target[0])
+    return client
+
+def body_digest(dbody: str):
+    """digest of DashboardBody used as version of dashboard
+
+    Args:
+        dbody (str): DashboardBody. None if dashboard does not exist.
+
+    Returns:
+        str: digest. None if dashboard does not exist.
+    """
+    if dbody is None:
+        return None
+    return hashlib.sha1(dbody.encode("utf-8")).hexdigest()
+
+def parse_dashboard(dbname: str, dbody: str, target: tuple=HOME_TARGET):
+    """build dashboard model from DashboardBody
+
+    Widgets are read one by one and kept as JSON fragments
+    except the last widget of each metrics. see dashboard_model.split_widgets()
+
+    Args:
+        dbname (str): dashboard name
+        dbody (str): DashboardBody. None if dashboard does not exist.
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        dict: dashboard model. see new_dashboard()
+    """
+    dashboard = new_dashboard(dbname, target)
+    dashboard["read_at"] = time.monotonic()
+    if dbody is None:
+        return dashboard
+    with registrar_metrics.timer("ParseTime"):
+        widgets = split_widgets(dbody, search_volumes)
+        dashboard["widgets"], dashboard["reged_widgets"], dashboard["totalmetrics"] = \
+            index_widgets(widgets)
+    registrar_metrics.count("WidgetsScanned", len(widgets))
+    dashboard["size"] = len(dbody.encode("utf-8"))
+    dashboard["digest"] = body_digest(dbody)
+    return dashboard
+
+def read_dashboard_body(client, dbname: str):
+    """call get_dashboard and record its metrics
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname (str): dashboard name
+
+    Returns:
+        str: DashboardBody
+    """
+    registrar_metrics.count("GetDashboardCalls")
+    with registrar_metrics.timer("GetDashboardTime"):
+        dbody = client.get_dashboard(DashboardName=dbname)['DashboardBody']
+    registrar_metrics.count("BodyBytesIn", len(dbody.encode("utf-8")), registrar_metrics.UNIT_BYTES)
+    return dbody
+
+def write_dashboard_body(client, dbname: str, dbody: str, deadline: float=None,
+                         acquired: bool=False):
+    """call put_dashboard and record its metrics
+
+    Whole DashboardBody is logged only in DEBUG level.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname (str): dashboard name
+        dbody (str): DashboardBody
+        deadline (float, optional): time.monotonic() which the put must be sent before.
+            see write_scheduler.put_dashboard()
+        acquired (bool, optional): a token of write_scheduler is already taken
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Add folowing dashboard:\n{0}".format(dbody))
+    registrar_metrics.count("PutDashboardCalls")
+    with registrar_metrics.timer("PutDashboardTime"):
+        write_scheduler.put_dashboard(client, dbname, dbody, deadline, acquired)
+    registrar_metrics.count("BodyBytesOut", len(dbody.encode("utf-8")), registrar_metrics.UNIT_BYTES)
+
+def get_dashboard_body(client, dbname: str):
+    """get DashboardBody
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname (str): dashboard name
+
+    Returns:
+        str: DashboardBody. None if dashboard does not exist.
+    """
+    try:
+        return read_dashboard_body(client, dbname)
+    except aws_clients.ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceNotFound":
+            raise
+    return None
+
+def load_dashboard(client, entry: dict, target: tuple=HOME_TARGET):
+    """get dashboard and categorize registered widgets by metrics
+
+    Dashboard model cached by previous invocation is used without get_dashboard
+    only if the entry has LastModified and Size of list_dashboards and they are
+    same as the cached ones, e.g. shards listed by deregister_volumes().
+    Models put by this container have no LastModified and entries of cached
+    shard index have no Size, so the body is read in most warm invocations and
+    only parsing is skipped if its digest is not changed.
+    The cache entry is taken out until cache_dashboard() is called.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        entry (dict): DashboardEntries element of list_dashboards
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        dict: dashboard model. see new_dashboard()
+    """
+    dbname = entry['DashboardName']
+    cached = dashboard_cache.pop(dbname, None)
+    if cached is not None and cached["LastModified"] is not None \
+            and cached["Size"] == entry.get('Size') \
+            and cached["LastModified"] == entry.get('LastModified'):
+        logger.info("Use cached dashboard {0}".format(dbname))
+        registrar_metrics.count("CacheHits")
+        return cached["dashboard"]
+    dbody = read_dashboard_body(client, dbname)
+    # same Size does not mean same body, e.g. a volume replaced by other writer
+    if cached is not None and cached["dashboard"]["digest"] == body_digest(dbody):
+        logger.info("Use cached dashboard {0} of same digest".format(dbname))
+        registrar_metrics.count("ParsesSkipped")
+        cached["dashboard"]["read_at"] = time.monotonic()
+        return cached["dashboard"]
+    dashboard = parse_dashboard(dbname, dbody, target)
+    logger.info("now total metrics: {0}".format(dashboard["totalmetrics"]))
+    return dashboard
+
+def load_shard(client, dbname: str, target: tuple=HOME_TARGET):
+    """get dashboard model by name
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname (str): dashboard name
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        dict: dashboard model. empty model if the dashboard does not exist.
+    """
+    try:
+        return load_dashboard(client, {"DashboardName": dbname}, target)
+    except aws_clients.ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceNotFound":
+            raise
+    return new_dashboard(dbname, target)
+
+def shard_utilization(dashboard: dict):
+    """utilization of dashboard limits
+
+    Args:
+        dashboard (dict): dashboard model
+
+    Returns:
+        float: percent of the most used limit
+    """
+    return max(dashboard["totalmetrics"] / MAX_METRICS_DBOARD,
+               dashboard["size"] / MAX_DBOARD_BYTES) * 100
+
+def estimate_free_volumes(entry: dict):
+    """estimate free_volumes() of dashboard from Size of list_dashboards
+
+    Number of rows is overestimated not to read full dashboards.
+
+    Args:
+        entry (dict): DashboardEntries element of list_dashboards
+
+    Returns:
+        int: number of volumes
+    """
+    if WIDGET_MODE == WIDGET_MODE_SEARCH:
+        rows = entry.get('Size', 0) // MIN_SEARCH_ROW_BYTES
+    else:
+        rows = entry.get('Size', 0) // MIN_ROW_BYTES
+    return volumes_fit(MAX_METRICS_DBOARD - rows, MAX_DBOARD_BYTES - entry.get('Size', 0))
+
+def candidate_shards(client, dbname_prefix: str):
+    """get shards which may have free space for new volumes
+
+    Shard index cached by previous invocation is used without
+    list_dashboards until SHARD_INDEX_TTL expires.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+
+    Returns:
+        tuple: ([DashboardEntries element ordered by numeric suffix],
+                name of the last shard. None if no shard exists)
+    """
+    cached = shard_index.get(dbname_prefix)
+    if cached is not None and cached["expires"] > time.time():
+        logger.info("Use cached shard index of {0}".format(dbname_prefix))
+        names = sorted(cached["free"].keys(), key=shard_number)
+        return [{"DashboardName": name} for name in names], cached["last"]
+    shard_index.pop(dbname_prefix, None)
+    entries = list_shards(client, dbname_prefix)
+    if not entries:
+        return [], None
+    candidates = [entry for entry in entries[:-1] if estimate_free_volumes(entry) > 0]
+    candidates.append(entries[-1])
+    return candidates, entries[-1]['DashboardName']
+
+def load_candidates(client, dbname_prefix: str, count: int, target: tuple=HOME_TARGET):
+    """load shards having free space for volumes and the last shard if they are not enough
+
+    Shard index cached by previous invocation may name shards deleted by compaction.
+    Then the index is dropped and shards are listed again.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        count (int): number of volumes
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        tuple: ([dashboard model ordered by numeric suffix],
+                name of the last shard. None if no shard exists)
+    """
+    for attempt in range(2):
+        candidates, last = candidate_shards(client, dbname_prefix)
+        dashboards = list()
+        if last is None:
+            return dashboards, last
+        free = 0
+        try:
+            for entry in candidates:
+                dashboards.append(load_dashboard(client, entry, target))
+                free += free_volumes(dashboards[-1])
+                if free >= count:
+                    break
+            # new shards are created after the last shard
+            if free < count and (not dashboards or dashboards[-1]["name"] != last):
+                dashboards.append(load_dashboard(client, {"DashboardName": last}, target))
+        except aws_clients.ClientError as e:
+            # shards are listed at the second attempt
+            if e.response["Error"]["Code"] != "ResourceNotFound" or attempt > 0:
+                raise
+            logger.info("Shard index of {0} is stale, list shards again".format(dbname_prefix))
+            registrar_metrics.count("StaleShardIndex")
+            shard_index.pop(dbname_prefix, None)
+            continue
+        return dashboards, last
+
+def update_shard_index(dbname_prefix: str, dashboards: list, last: str):
+    """cache free space of shards for next invocation
+
+    Args:
+        dbname_prefix (str): dashboard name prefix
+        dashboards (list): dashboard models read or written
+        last (str): name of the last shard
+    """
+    # shards not put yet do not exist
+    dashboards = [dashboard for dashboard in dashboards if dashboard["digest"] is not None]
+    names = [name for name in [last] + [dashboard["name"] for dashboard in dashboards] if name is not None]
+    if not names:
+        shard_index.pop(dbname_prefix, None)
+        return
+    cached = shard_index.get(dbname_prefix)
+    if cached is None:
+        cached = {"free": dict(), "last": last}
+    for dashboard in dashboards:
+        if free_volumes(dashboard) > 0:
+            cached["free"][dashboard["name"]] = free_volumes(dashboard)
+        else:
+            cached["free"].pop(dashboard["name"], None)
+    cached["last"] = max(names, key=shard_number)
+    cached["expires"] = time.time() + SHARD_INDEX_TTL
+    shard_index[dbname_prefix] = cached
+
+def cache_dashboard(dashboard: dict, dbody: str):
+    """cache dashboard model put to cloudwatch for next invocation
+
+    Args:
+        dashboard (dict): dashboard model
+        dbody (str): DashboardBody put to cloudwatch
+    """
+    dashboard["size"] = len(dbody.encode("utf-8"))
+    dashboard["digest"] = body_digest(dbody)
+    dashboard["pending"] = []
+    dashboard["removed"] = set()
+    # LastModified is unknown until next list_dashboards
+    dashboard_cache[dashboard["name"]] = {"LastModified": None,
+                                          "Size": len(dbody.encode("utf-8")),
+                                          "dashboard": dashboard}
+
+def merge_dashboard(dashboard: dict, dbody: str):
+    """apply pending changes of dashboard model to DashboardBody written by other writer
+
+    Args:
+        dashboard (dict): dashboard model
+        dbody (str): current DashboardBody. None if dashboard does not exist.
+
+    Returns:
+        tuple: (merged dashboard model, [VolumeId which does not fit in dashboard])
+    """
+    merged = parse_dashboard(dashboard["name"], dbody, dashboard["target"])
+    remove_volumes_from_dashboard(merged, dashboard["removed"])
+    reged = registered_volumes(merged)
+    overflow = list()
+    for volid in dashboard["pending"]:
+        if volid in reged:
+            continue
+        plan = plan_volume(merged, volid)
+        if is_limit_dashboard(merged, plan):
+            overflow.append(volid)
+            continue
+        add_volume_to_dashboard(merged, volid, plan)
+    merged["pending"] = [volid for volid in dashboard["pending"] if volid not in overflow]
+    merged["removed"] = set(dashboard["removed"])
+    return merged, overflow
+
+def put_deadline(checked_at: float):
+    """time.monotonic() which a put must be sent before after its compare-and-swap check
+
+    Other writer which put after the check verifies its put PUT_VERIFY_DELAY
+    seconds later, so this put must land before that. Half of the delay is
+    left for the put itself.
+
+    Args:
+        checked_at (float): time.monotonic() when the digest was read
+
+    Returns:
+        float: deadline. None if PUT_VERIFY_DELAY is 0
+    """
+    if PUT_VERIFY_DELAY <= 0:
+        return None
+    return checked_at + PUT_VERIFY_DELAY / 2
+
+def put_dashboard_cas(client, dashboard: dict):
+    """put dashboard after compare-and-swap check
+
+    Dashboard is read before put and merged if its digest is not same as
+    the digest when it was loaded. The read is skipped until put_deadline()
+    of the last read, because other writer which put after that read
+    still verifies its put after this put.
+    The token of the put is taken before the check, and if backoff of
+    write_scheduler delays the put beyond put_deadline() of the check,
+    the put is not sent and the dashboard is checked again.
+    The put is verified by verify_dashboard() after PUT_VERIFY_DELAY seconds.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dashboard (dict): dashboard model
+
+    Returns:
+        tuple: (dashboard model put, DashboardBody put,
+                [VolumeId which does not fit in dashboard])
+
+    Raises:
+        write_scheduler.DeadlineExceeded: the put was delayed MAX_PUT_RETRIES times
+    """
+    overflow = list()
+    for attempt in range(MAX_PUT_RETRIES):
+        # token waits are not between the check and the put
+        acquired = write_scheduler.acquire(client, "put_dashboard")
+        deadline = None if dashboard["read_at"] is None else put_deadline(dashboard["read_at"])
+        if deadline is None or time.monotonic() >= deadline:
+            current = get_dashboard_body(client, dashboard["name"])
+            deadline = put_deadline(time.monotonic())
+            if body_digest(current) != dashboard["digest"]:
+                logger.info("Dashboard {0} was updated by other writer, merge it".format(dashboard["name"]))
+                registrar_metrics.count("Conflicts")
+                dashboard, dropped = merge_dashboard(dashboard, current)
+                overflow.extend(dropped)
+        else:
+            registrar_metrics.count("PreReadsSkipped")
+        dbody = dump_dashboard(dashboard)
+        try:
+            write_dashboard_body(client, dashboard["name"], dbody, deadline, acquired)
+        except write_scheduler.DeadlineExceeded:
+            logger.info("Put of dashboard {0} was delayed, check it again".format(dashboard["name"]))
+            registrar_metrics.count("DelayedPuts")
+            dashboard["read_at"] = None
+            continue
+        if deadline is not None and time.monotonic() > deadline + PUT_VERIFY_DELAY / 2:
+            # other writer may have verified its put before this put landed
+            logger.warning("Put of dashboard {0} took longer than PUT_VERIFY_DELAY".format(dashboard["name"]))
+            registrar_metrics.count("LatePuts")
+        return dashboard, dbody, overflow
+    raise write_scheduler.DeadlineExceeded("put_dashboard")
+
+def verify_dashboard(client, dashboard: dict, dbody: str):
+    """read dashboard put by put_dashboard_cas() to verify pending changes are applied
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dashboard (dict): dashboard model put
+        dbody (str): DashboardBody put
+
+    Returns:
+        tuple: (dashboard model written, DashboardBody written)
+            (None, None) if other writer overwrote it.
+    """
+    written = get_dashboard_body(client, dashboard["name"])
+    if written == dbody:
+        dashboard["read_at"] = time.monotonic()
+        return dashboard, dbody
+    if written is not None:
+        merged = parse_dashboard(dashboard["name"], written, dashboard["target"])
+        if has_volumes(merged, dashboard["pending"]) \
+                and not (dashboard["removed"] & registered_volumes(merged)):
+            return merged, written
+    logger.info("Dashboard {0} was overwritten by other writer".format(dashboard["name"]))
+    return None, None
+
+def write_dashboards(client, dashboards: list, dbname_prefix: str=None):
+    """put dashboard models which have pending changes
+
+    Elements of dashboards are replaced with the dashboard models written.
+    With OPTIMISTIC_LOCK, all dashboards are put first and verified after
+    one PUT_VERIFY_DELAY, and overwritten ones are retried with jittered backoff.
+    Reverse index of the prefix is updated after each verified put.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dashboards (list): dashboard models
+        dbname_prefix (str, optional): dashboard name prefix of reverse index.
+            Reverse index is not updated if None.
+
+    Returns:
+        tuple: ([dashboard name failed to put], [VolumeId which does not fit in dashboard])
+    """
+    failed = list()
+    overflow = list()
+    retries = [i for i, dashboard in enumerate(dashboards) if dashboard["pending"] or dashboard["removed"]]
+    for attempt in range(MAX_PUT_RETRIES if OPTIMISTIC_LOCK else 1):
+        if not retries:
+            break
+        if attempt > 0:
+            registrar_metrics.count("Retries", len(retries))
+            time.sleep(random.uniform(0, PUT_BACKOFF_BASE * (2 ** attempt)))
+        puts = list()
+        for i in retries:
+            dashboard = dashboards[i]
+            try:
+                if OPTIMISTIC_LOCK:
+                    dashboard, dbody, dropped = put_dashboard_cas(client, dashboard)
+                else:
+                    dbody, dropped = dump_dashboard(dashboard), []
+                    write_dashboard_body(client, dashboard["name"], dbody)
+            except (aws_clients.BotoCoreError,
+                    aws_clients.ClientError,
+                    write_scheduler.DeadlineExceeded) as e:
+                logger.error("Failed to put dashboard {0}: {1}".format(dashboard["name"], e))
+                failed.append(dashboard["name"])
+                continue
+            for volid in dropped:
+                logger.warning("Dashboard {0} is full, {1} is not registered".format(dashboard["name"], volid))
+            overflow.extend(dropped)
+            puts.append((i, dashboard, dbody))
+        retries = list()
+        if OPTIMISTIC_LOCK and puts:
+            # wait once for writers which read before these puts to finish their put
+            time.sleep(PUT_VERIFY_DELAY)
+        for i, dashboard, dbody in puts:
+            written, wbody = dashboard, dbody
+            if OPTIMISTIC_LOCK:
+                try:
+                    written, wbody = verify_dashboard(client, dashboard, dbody)
+                except (aws_clients.BotoCoreError,
+                        aws_clients.ClientError) as e:
+                    logger.error("Failed to verify dashboard {0}: {1}".format(dashboard["name"], e))
+                    failed.append(dashboard["name"])
+                    continue
+            if written is None:
+                # digest is of the body before this put, merged at next attempt
+                dashboard["read_at"] = None
+                dashboards[i] = dashboard
+                retries.append(i)
+                continue
+            dashboards[i] = written
+            if dbname_prefix is not None:
+                init_dedupe_store().update(dbname_prefix,
+                                           dashboard_locations(written, set(dashboard["pending"])),
+                                           dashboard["removed"])
+            cache_dashboard(written, wbody)
+            registrar_metrics.gauge("MaxShardUtilization", shard_utilization(written),
+                                    registrar_metrics.UNIT_PERCENT)
+    for i in retries:
+        logger.error("Failed to put dashboard {0}: conflicts".format(dashboards[i]["name"]))
+        failed.append(dashboards[i]["name"])
+    return failed, overflow
+
+def find_volumes(dashboards: list, volids: list):
+    """locations of volumes registered to dashboard models
+
+    Args:
+        dashboards (list): dashboard models
+        volids (list): VolumeIds
+
+    Returns:
+        dict: {VolumeId: location} of volumes found. see dedupe_store.volume_location()
+    """
+    found = dict()
+    pending = set(volids)
+    for dashboard in dashboards:
+        if not pending:
+            break
+        found.update(dashboard_locations(dashboard, pending))
+        pending -= set(found)
+    return found
+
+def scan_registered_volumes(client, dbname_prefix: str, target: tuple=HOME_TARGET):
+    """rebuild reverse index from all shards once per container
+
+    Dashboard models read are cached for following load_dashboard().
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+    """
+    if dbname_prefix in scanned_prefixes:
+        return
+    locations = dict()
+    for entry in list_shards(client, dbname_prefix):
+        dashboard = load_dashboard(client, entry, target)
+        locations.update(dashboard_locations(dashboard))
+        dashboard_cache[dashboard["name"]] = {"LastModified": entry.get('LastModified'),
+                                              "Size": entry.get('Size'),
+                                              "dashboard": dashboard}
+    init_dedupe_store().rebuild(dbname_prefix, locations)
+    scanned_prefixes.add(dbname_prefix)
+    logger.info("{0} volumes are registered to {1}".format(len(locations), dbname_prefix))
+
+def locate_volumes(client, dbname_prefix: str, volids: list, target: tuple=HOME_TARGET):
+    """find dashboards, widgets and metrics ids of volumes from reverse index
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        volids (list): VolumeIds
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        dict: {VolumeId: location} of volumes found. see dedupe_store.volume_location()
+    """
+    if DEDUPE_SCAN:
+        scan_registered_volumes(client, dbname_prefix, target)
+    return init_dedupe_store().locate(dbname_prefix, volids)
+
+def register_volumes(client, dbname_prefix: str, volids: list, target: tuple=HOME_TARGET):
+    """register metrics of volumes to dashboards in one pass
+
+    Volumes are placed to shards having free space in memory and
+    put_dashboard is called once per touched dashboard.
+    Volumes already registered are skipped by dedupe store, cached and loaded
+    dashboard models, so redelivered events do not put dashboards.
+    VolumeIds which could not be registered are not in the result.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        volids (list): VolumeIds
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        tuple: ({VolumeId: dashboard name}, [dashboard name failed to put])
+    """
+    failed = list()
+    if not volids:
+        return dict(), failed
+    # volumes registered by previous invocations return early without reading dashboards
+    if DEDUPE_SCAN:
+        scan_registered_volumes(client, dbname_prefix, target)
+    store = init_dedupe_store()
+    registered = store.registered(dbname_prefix, volids)
+    pattern = shard_pattern(dbname_prefix)
+    # shard groups are registered in threads. see write_routes()
+    cached = [cached["dashboard"] for name, cached in list(dashboard_cache.items()) if pattern.match(name)]
+    found = find_volumes(cached, [volid for volid in volids if volid not in registered])
+    volids = [volid for volid in volids if volid not in registered and volid not in found]
+    if not volids:
+        store.add(dbname_prefix, found)
+        registered.update({volid: location["dashboard"] for volid, location in found.items()})
+        logger.info("{0} are already registered".format(", ".join(registered)))
+        registrar_metrics.count("DuplicatesSkipped", len(registered))
+        return registered, failed
+    # defines dashboards register metrics
+    dashboards, last = load_candidates(client, dbname_prefix, len(volids), target)
+    if last is None:
+        dashboards = [new_dashboard(next(gen_dbname(dbname_prefix)), target)]
+    found.update(find_volumes(dashboards, volids))
+    # volumes registered by other writers are added to reverse index
+    store.add(dbname_prefix, found)
+    registered.update({volid: location["dashboard"] for volid, location in found.items()})
+    volids = [volid for volid in volids if volid not in registered]
+    if registered:
+        logger.info("{0} are already registered".format(", ".join(registered)))
+        registrar_metrics.count("DuplicatesSkipped", len(registered))
+    touched, placed = pack_volumes(dashboards, volids,
+                                   lambda name: load_shard(client, init_dbinfos(name), target))
+    for dashboard in touched:
+        logger.info("total metrics of {0} will {1}".format(dashboard["name"], dashboard["totalmetrics"]))
+
+    # apply updates to dashboards
+    failed, overflow = write_dashboards(client, touched, dbname_prefix)
+    for volid in overflow:
+        placed.pop(volid, None)
+    registered.update(placed)
+    if failed:
+        shard_index.pop(dbname_prefix, None)
+    else:
+        update_shard_index(dbname_prefix, dashboards + touched, last)
+    return registered, failed
+
+def deregister_volumes(client, dbname_prefix: str, volids: list, target: tuple=HOME_TARGET):
+    """remove metrics of volumes from dashboards having the prefix
+
+    Dashboards of volumes in reverse index are read first and
+    other shards are read only for volumes which are not found in them.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        volids (list): VolumeIds
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        tuple: ({VolumeId: dashboard name}, [dashboard name failed to put])
+    """
+    removed = dict()
+    if not volids:
+        return removed, list()
+    targets = set(volids)
+    located = {location["dashboard"]
+               for location in locate_volumes(client, dbname_prefix, volids, target).values()}
+    touched = list()
+    dashboards = list()
+    entries = list_shards(client, dbname_prefix)
+    for entry in sorted(entries, key=lambda x: x['DashboardName'] not in located):
+        if targets <= set(removed):
+            break
+        dashboard = load_dashboard(client, entry, target)
+        dashboards.append(dashboard)
+        for volid in remove_volumes_from_dashboard(dashboard, targets):
+            removed[volid] = dashboard["name"]
+        if dashboard["removed"]:
+            logger.info("Remove {0} from dashboard {1}".format(
+                ", ".join(dashboard["removed"]), dashboard["name"]))
+            touched.append(dashboard)
+        else:
+            # dashboard is not changed, keep cache of it
+            dashboard_cache[dashboard["name"]] = {"LastModified": entry.get('LastModified'),
+                                                  "Size": entry.get('Size'),
+                                                  "dashboard": dashboard}
+    failed, _ = write_dashboards(client, touched, dbname_prefix)
+    # volumes not found in any dashboards
+    init_dedupe_store().remove(dbname_prefix, [volid for volid in volids if volid not in removed])
+    if failed:
+        shard_index.pop(dbname_prefix, None)
+    elif entries:
+        # shards which volumes are removed from have free space
+        update_shard_index(dbname_prefix, dashboards + touched, entries[-1]['DashboardName'])
+    return removed, failed
+
+def locate_routes(client, dbname_prefix: str, volids: list, target: tuple=HOME_TARGET):
+    """find volumes registered to any shard group of the target
+
+    A volume may be registered to other shard group than its route,
+    e.g. registered before SHARD_ROUTING was changed or its tag was set.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix of the target
+        volids (list): VolumeIds
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        dict: {VolumeId: dashboard name}
+    """
+    found = dict()
+    patterns = (shard_pattern(dbname_prefix), route_pattern(dbname_prefix))
+    cached = [cached["dashboard"] for name, cached in list(dashboard_cache.items())
+              if any(pattern.match(name) for pattern in patterns)]
+    found.update({volid: location["dashboard"]
+                  for volid, location in find_volumes(cached, volids).items()})
+    if len(found) == len(volids):
+        return found
+    for prefix in shard_prefixes(client, dbname_prefix):
+        pending = [volid for volid in volids if volid not in found]
+        if not pending:
+            break
+        found.update({volid: location["dashboard"]
+                      for volid, location in locate_volumes(client, prefix, pending, target).items()})
+    return found
+
+def write_routes(func, client, groups: dict, target: tuple=HOME_TARGET):
+    """call register_volumes() or deregister_volumes() for shard groups at once
+
+    Shard groups wait PUT_VERIFY_DELAY of its puts in parallel
+    with SHARD_GROUP_WORKERS threads at most.
+
+    Args:
+        func: register_volumes or deregister_volumes
+        client (boto3.client): cloudwatch client
+        groups (dict): {dashboard name prefix: [VolumeId]}. see group_routes()
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        tuple: ({VolumeId: dashboard name}, [dashboard name failed to put])
+    """
+    done = dict()
+    failed = list()
+    if len(groups) > 1:
+        # dedupe store is created before threads use it
+        init_dedupe_store()
+        with ThreadPoolExecutor(max_workers=min(len(groups), SHARD_GROUP_WORKERS)) as pool:
+            results = list(pool.map(lambda group: func(client, group[0], group[1], target),
+                                    groups.items()))
+    else:
+        results = [func(client, prefix, volids, target) for prefix, volids in groups.items()]
+    for found, failed_put in results:
+        done.update(found)
+        failed.extend(failed_put)
+    return done, failed
+
+def register_routes(client, dbname_prefix: str, volumes: dict, target: tuple=HOME_TARGET):
+    """register volumes to shards of its shard group
+
+    Concurrent invocations write different dashboards
+    unless SHARD_ROUTING is SHARD_ROUTING_FILL.
+    Volumes registered to other shard groups are not registered again.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix of the target
+        volumes (dict): {VolumeId: route key}
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        tuple: ({VolumeId: dashboard name}, [dashboard name failed to put])
+    """
+    registered = dict()
+    if SHARD_ROUTING != SHARD_ROUTING_FILL and volumes:
+        registered = locate_routes(client, dbname_prefix, list(volumes), target)
+        if registered:
+            logger.info("{0} are already registered".format(", ".join(registered)))
+            registrar_metrics.count("DuplicatesSkipped", len(registered))
+        volumes = {volid: route for volid, route in volumes.items() if volid not in registered}
+    groups = group_routes(dbname_prefix, volumes)
+    placed, failed = write_routes(register_volumes, client, groups, target)
+    update_route_index(dbname_prefix, [prefix for prefix, volids in groups.items()
+                                       if any(volid in placed for volid in volids)])
+    registered.update(placed)
+    return registered, failed
+
+def deregister_routes(client, dbname_prefix: str, volumes: dict, target: tuple=HOME_TARGET):
+    """remove volumes from shards of its shard group
+
+    Volumes which are not found in its shard group are searched in
+    other shard groups, e.g. deleted volumes whose event has no tags.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix of the target
+        volumes (dict): {VolumeId: route key}
+        target (tuple, optional): (region, account) of volumes. see volume_target()
+
+    Returns:
+        tuple: ({VolumeId: dashboard name}, [dashboard name failed to put])
+    """
+    groups = group_routes(dbname_prefix, volumes)
+    removed, failed = write_routes(deregister_volumes, client, groups, target)
+    if SHARD_ROUTING == SHARD_ROUTING_FILL or len(removed) == len(volumes):
+        return removed, failed
+    for prefix in shard_prefixes(client, dbname_prefix):
+        volids = [volid for volid in volumes if volid not in removed]
+        if not volids:
+            break
+        if prefix in groups:
+            continue
+        found, failed_put = deregister_volumes(client, prefix, volids, target)
+        removed.update(found)
+        failed.extend(failed_put)
+    return removed, failed
+
@@ -0,0 +1,943 @@
+import re
+import os
+import json
+import logging
+import registrar_metrics
+
+"""
+CloudWatch ダッシュボードのモデルを操作する共通モジュール
+
+ウィジェットの作成やメトリクスの追加, シャードの命名など
+ダッシュボード本体の組み立てだけを扱う。AWS のモジュールは読み込まないため
+コールドスタートやテストで botocore を読み込まずに使える。
+DashboardBody はウィジェットごとに読み込み, 変更しないウィジェットは
+JSON の断片のまま書き戻す。
+ダッシュボードモデルへのボリュームの配置や削除, SEARCH 式の組み立ても扱い,
+SQS のハンドラと突き合わせ処理で共有する。
+"""
+
+
+MAX_METRICS = 100
+MAX_DBOARD = 1000
+METRICS_VOLREAD = "VolumeReadBytes"
+METRICS_VOLWRITE = "VolumeWriteBytes"
+METRICS_VOLREADOPS = "VolumeReadOps"
+METRICS_VOLWRITEOPS = "VolumeWriteOps"
+METRICS_NAMES = [name.strip() for name in os.getenv(
+    'METRICS_NAMES',
+    ",".join([METRICS_VOLREAD, METRICS_VOLWRITE, METRICS_VOLREADOPS, METRICS_VOLWRITEOPS])
+).split(",") if name.strip()]
+METRICS_TEMPLATE = {name: {"widget": tuple(),
+                           "metrics": [{"DimensionName": name, "VolumeId": ""}]}
+                    for name in METRICS_NAMES}
+
+# longer names first not to match a prefix of other name
+WIDGET_TITLE_PATTERN = re.compile(r"({0})\s*(\d*)".format(
+    "|".join([re.escape(name) for name in sorted(METRICS_TEMPLATE.keys(), key=len, reverse=True)])))
+
+JSON_SEPARATORS = (",", ":")
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+JSON_DECODER = json.JSONDecoder()
+
+WIDGET_WIDTH = 6
+WIDGET_HEIGHT = 6
+WIDGET_TEMPLATE = {
+    "type": "metric",
+    "x": 0,
+    "y": 0,
+    "width": WIDGET_WIDTH,
+    "height": WIDGET_HEIGHT,
+    "properties": {
+        "stacked": False,
+        "metrics": [],
+        "title": "",
+        "region": "ap-northeast-1",
+        "period": 300,
+    "view": "timeSeries"
+    }
+}
+
+MAX_METRICS_DBOARD = 400
+MAX_DBOARD_BYTES = 1024 * 1024
+# upper bound of bytes of a metrics row
+ESTIMATED_ROW_BYTES = 110
+# metrics rows added per volume. m and e rows for each metrics
+VOLUME_ROWS = len(METRICS_TEMPLATE) * 2
+
+# "metrics" writes rows per volume, "search" writes SEARCH expressions per metrics
+WIDGET_MODE_METRICS = "metrics"
+WIDGET_MODE_SEARCH = "search"
+WIDGET_MODE = os.getenv('WIDGET_MODE', WIDGET_MODE_METRICS).lower()
+# "ids" searches VolumeIds listed in expression, "all" searches all volumes
+SEARCH_SCOPE_IDS = "ids"
+SEARCH_SCOPE_ALL = "all"
+SEARCH_SCOPE = os.getenv('SEARCH_SCOPE', SEARCH_SCOPE_IDS).lower()
+# additional search term of "all" scope. e.g. a part of VolumeId
+SEARCH_FILTER = os.getenv('SEARCH_FILTER', '')
+SEARCH_TEMPLATE = "SEARCH('{{AWS/EBS,VolumeId}} MetricName=\"{0}\"{1}', 'Average', 300)/300"
+SEARCH_LABEL = "${PROP('Dim.VolumeId')}"
+SEARCH_VOLUME_PATTERN = re.compile(r'VolumeId="([^"]+)"')
+MAX_SEARCH_LENGTH = 1024
+# time series returned by SEARCH expressions of a widget
+MAX_SEARCH_SERIES = 500
+# bytes of ' OR VolumeId=\"vol-...\"' in DashboardBody
+SEARCH_ID_BYTES = 40
+SEARCH_IDS_PER_ROW = (MAX_SEARCH_LENGTH - 100) // (SEARCH_ID_BYTES - 4)
+SEARCH_ROWS_WIDGET = MAX_SEARCH_SERIES // SEARCH_IDS_PER_ROW
+
+logger = logging.getLogger()
+
+def init_dbinfos(dbname: str):
+    """initialize informations related dashboard
+
+    Use this method you want to create a new dashboard
+    
+    Args:
+        dbname (str): dashboard name
+    
+    Returns:
+        str: new dashboard name
+    """
+    match = re.match(r"(.*?)(\d+)$", dbname)
+    if match:
+        dbname = "{0}{1}".format(match.group(1), str((int(match.group(2)) + 1)))
+    else:
+        dbname = "{0}-2".format(dbname)
+    return dbname
+
+def create_widget(widget_title: str,
+                  metrics: list=None,
+                  width: int=WIDGET_WIDTH,
+                  height: int=WIDGET_HEIGHT,
+                  region: str=None):
+    """create new widget to the specified dashboard.
+    
+    Args:
+        widget_title (str): widget title you create
+        metrics (list): metrics you want to add to widget
+            [{"DimensionName": "VolumeReadBytes",
+              "VolumeId": "vol-xxxx",
+              "AccountId": "123456789012" (optional)},]
+        width (int, optional): widget width. Defaults to WIDGET_WIDTH.
+        height (int, optional): widget height. Defaults to WIDGET_HEIGHT.
+        region (str, optional): region of metrics. Defaults to region of WIDGET_TEMPLATE.
+    """
+    widget = dict(WIDGET_TEMPLATE, width=width, height=height)
+    widget["properties"] = dict(WIDGET_TEMPLATE["properties"], metrics=list(), title=widget_title)
+    if region is not None:
+        widget["properties"]["region"] = region
+    if metrics is not None:
+        for i, metric in enumerate(metrics):
+            widget["properties"]["metrics"].extend(metric_rows(metric, i + 1))
+    return widget
+
+def metric_rows(metric: dict, num: int):
+    """create m/e metrics rows of a volume
+
+    Args:
+        metric (dict): {"DimensionName": "VolumeReadBytes", "VolumeId": "vol-xxxx"}
+            metrics of other account has "AccountId", and metrics of other region
+            than the widget has "Region".
+        num (int): id number of m/e
+
+    Returns:
+        list: metrics rows
+    """
+    options = {"id": "m{0}".format(num),
+               "label": metric["VolumeId"]
+              }
+    if metric.get("AccountId"):
+        options["accountId"] = metric["AccountId"]
+    if metric.get("Region"):
+        options["region"] = metric["Region"]
+    return [["AWS/EBS",
+             metric["DimensionName"],
+             "VolumeId",
+             metric["VolumeId"],
+             options],
+            [{"expression": "SUM(METRICS('m{0}'))/300".format(num),
+              "label": metric["VolumeId"],
+              "id": "e{0}".format(num)}]]
+
+def widget_title(key: str, number: int):
+    """title of widget of metrics
+
+    Args:
+        key (str): metrics name
+        number (int): title number of widget
+
+    Returns:
+        str: title
+    """
+    if number == 1:
+        return key
+    return "{0} {1}".format(key, number)
+
+def add_metrics_to_widget(widget_body: dict, metrics: list, nextid: int=None):
+    """add new metrics to widget
+    
+    Args:
+        widget_body (dict): widget body
+        metrics (list): metrics you want to add to widget
+            [{"DimensionName": "VolumeReadBytes",
+              "VolumeId": "vol-xxxx"},]
+        nextid (int, optional): next free id number of m/e.
+            Defaults to number after the id of last metrics.
+    Return:
+        list
+    """
+    # creates new widget when registered metrics is over limitation
+    if len(widget_body["properties"]["metrics"]) > (MAX_METRICS - (len(metrics)*2)):
+        match = re.match(r"(.*?)(\d+)$", widget_body["properties"]["title"])
+        if match:
+            title = "{0}{1}".format(match.group(1), str((int(match.group(2)) + 1)))
+        else:
+            title = "{0} 2".format(widget_body["properties"]["title"])
+        widget = create_widget(title, metrics)
+        return widget
+    if nextid is not None:
+        lastid = nextid - 1
+    else:
+        lastid = int(widget_body['properties']['metrics'][-1][-1]['id'][1:])
+    for metric in metrics:
+        widget_body["properties"]["metrics"].extend(metric_rows(metric, lastid + 1))
+        lastid += 1
+    return widget_body
+
+def is_limit_regmetrics(widget: dict, metrics: list):
+    """checks widget whether it register metrics
+    
+    Args:
+        widget (dict): widget body
+    """
+    if len(widget["properties"]["metrics"]) > (MAX_METRICS - (len(metrics)*2)):
+        return True
+    else:
+        return False
+
+def gen_dbname(name: str):
+    """
+    
+    Args:
+        name (str): [description]
+    """
+    i = 1
+    while i < MAX_DBOARD:
+        yield "{0} {1}".format(name, i)
+        i += 1
+
+def shard_number(dbname: str):
+    """sort key of dashboard by numeric suffix made by gen_dbname()
+
+    Args:
+        dbname (str): dashboard name
+
+    Returns:
+        tuple: (suffix number, dashboard name). suffix is 0 if not exists.
+    """
+    match = re.search(r"(\d+)$", dbname)
+    if match:
+        return (int(match.group(1)), dbname)
+    return (0, dbname)
+
+def shard_pattern(dbname_prefix: str):
+    """pattern of dashboard names made by gen_dbname() for the prefix
+
+    Args:
+        dbname_prefix (str): dashboard name prefix
+
+    Returns:
+        re.Pattern: compiled pattern
+    """
+    return re.compile(r"{0}([ -]\d+)?$".format(re.escape(dbname_prefix)))
+
+def get_metrics_template():
+    return {key: {"widget": tuple(),
+                  "metrics": [dict(metric) for metric in value["metrics"]]}
+            for key, value in METRICS_TEMPLATE.items()}
+
+def widget_index():
+    """create empty widget index of a metrics
+
+    Returns:
+        dict: widget index
+            {"widgets": [widget sorted by title number],
+             "number": title number of last widget,
+             "nextid": next free id number of m/e in last widget}
+    """
+    return {"widgets": [], "number": 0, "nextid": 1}
+
+def index_widgets(widgets: list):
+    """categorize widgets by metrics in single pass
+
+    Last widget of each metrics is decoded to add metrics to it.
+
+    Args:
+        widgets (list): widgets of dashboard body. dict or RawWidget
+
+    Returns:
+        tuple: ([widget not managed], {metrics name: widget index}, total metrics)
+    """
+    others = list()
+    numbered = {key: list() for key in METRICS_TEMPLATE.keys()}
+    totalmetrics = 0
+    for widget in widgets:
+        title, nrows = widget_summary(widget)
+        totalmetrics += nrows
+        match = WIDGET_TITLE_PATTERN.match(title)
+        if match is None:
+            others.append(widget)
+            continue
+        numbered[match.group(1)].append((int(match.group(2) or 1), widget))
+    reged_widgets = dict()
+    for key, items in numbered.items():
+        reged_widgets[key] = widget_index()
+        if not items:
+            continue
+        items.sort(key=lambda x: x[0])
+        last = decode_widget(items[-1][1])
+        rows = last["properties"]["metrics"]
+        reged_widgets[key]["widgets"] = [widget for _, widget in items[:-1]] + [last]
+        reged_widgets[key]["number"] = items[-1][0]
+        reged_widgets[key]["nextid"] = max([int(row[-1]["id"][1:]) for row in rows], default=0) + 1
+    return others, reged_widgets, totalmetrics
+
+def append_metrics(windex: dict, key: str, metrics: list, region: str=None):
+    """add metrics to last widget of the widget index
+
+    Args:
+        windex (dict): widget index. see widget_index()
+        key (str): metrics name
+        metrics (list): metrics you want to add to widget
+            [{"DimensionName": "VolumeReadBytes",
+              "VolumeId": "vol-xxxx"},]
+        region (str, optional): region of metrics. New widget is created in the region
+            and rows added to a widget of other region have the region in its options.
+    """
+    widgets = windex["widgets"]
+    # create a next widget if its does not exists or is over limitation
+    if not widgets or is_limit_regmetrics(widgets[-1], metrics):
+        windex["number"] += 1
+        widgets.append(create_widget(widget_title(key, windex["number"]), metrics, region=region))
+        windex["nextid"] = len(metrics) + 1
+    else:
+        if region is not None and region != widgets[-1]["properties"].get("region"):
+            metrics = [dict(metric, Region=region) for metric in metrics]
+        add_metrics_to_widget(widgets[-1], metrics, windex["nextid"])
+        windex["nextid"] += len(metrics)
+
+def is_registered(reged_widgets: dict, volid: str):
+    """checks metrics of the volume are registered to all widget indexes
+
+    Args:
+        reged_widgets (dict): {metrics name: widget index}
+        volid (str): VolumeId
+
+    Returns:
+        bool: True if registered
+    """
+    for windex in reged_widgets.values():
+        if not any(volid in rowvols
+                   for widget in windex["widgets"] for rowvols, _ in widget_series(widget)):
+            return False
+    return True
+
+def volume_locations(dbname: str, reged_widgets: dict, volids: set=None, row_volumes=None):
+    """reverse index entries of volumes registered to widgets
+
+    Args:
+        dbname (str): dashboard name
+        reged_widgets (dict): {metrics name: widget index}
+        volids (set, optional): VolumeIds to locate. All volumes if None.
+        row_volumes (optional): function returns VolumeIds of a row without
+            VolumeId dimension. e.g. SEARCH expression.
+
+    Returns:
+        dict: {VolumeId: {"dashboard": dbname, "series": [[widget title, ids...]]}}
+            see dedupe_store.volume_location()
+    """
+    locations = dict()
+    for windex in reged_widgets.values():
+        for widget in windex["widgets"]:
+            title, _ = widget_summary(widget)
+            for rowvols, ids in widget_series(widget, row_volumes):
+                for volid in rowvols:
+                    if volids is None or volid in volids:
+                        locations.setdefault(volid, {"dashboard": dbname, "series": []})
+                        locations[volid]["series"].append([title] + list(ids))
+    return locations
+
+def row_series(rows: list, row_volumes=None):
+    """VolumeIds and metrics ids of metrics rows
+
+    Args:
+        rows (list): metrics rows of widget
+        row_volumes (optional): see volume_locations()
+
+    Returns:
+        list: [(VolumeIds, metrics ids)] of rows having volumes
+    """
+    series = list()
+    for row in rows:
+        if len(row) > 3 and row[2] == "VolumeId":
+            # e row of m row has the same number
+            series.append(((row[3],), (row[-1]["id"], "e{0}".format(row[-1]["id"][1:]))))
+        elif row_volumes is not None:
+            rowvols = row_volumes(row)
+            if rowvols:
+                series.append((tuple(rowvols), (row[-1]["id"],)))
+    return series
+
+class RawWidget:
+    """widget kept as JSON fragment of DashboardBody
+
+    Only title, number of metrics rows and VolumeIds of managed widget
+    are kept decoded. Unchanged widget is written back as the fragment.
+
+    Args:
+        raw (str): JSON of widget
+        widget (dict): decoded widget. It is not kept.
+        row_volumes (optional): see volume_locations()
+    """
+    __slots__ = ("raw", "title", "nrows", "series")
+
+    def __init__(self, raw: str, widget: dict, row_volumes=None):
+        self.raw = raw
+        self.title, self.nrows = widget_summary(widget)
+        self.series = tuple()
+        if WIDGET_TITLE_PATTERN.match(self.title):
+            self.series = tuple(row_series(widget["properties"]["metrics"], row_volumes))
+
+def split_widgets(dbody: str, row_volumes=None):
+    """read widgets of DashboardBody one by one
+
+    Each widget is decoded and dropped after RawWidget is made of it,
+    so that whole dashboard is never materialized.
+    Keys of DashboardBody other than widgets are skipped.
+
+    Args:
+        dbody (str): DashboardBody
+        row_volumes (optional): see volume_locations()
+
+    Returns:
+        list: RawWidget
+    """
+    widgets = list()
+    pos = expect_json(dbody, 0, "{")
+    if dbody[pos:pos + 1] == "}":
+        return widgets
+    while True:
+        key, pos = JSON_DECODER.raw_decode(dbody, pos)
+        pos = expect_json(dbody, pos, ":")
+        if key != "widgets":
+            _, pos = JSON_DECODER.raw_decode(dbody, pos)
+        else:
+            pos = expect_json(dbody, pos, "[")
+            if dbody[pos:pos + 1] == "]":
+                pos = expect_json(dbody, pos, "]")
+            else:
+                while True:
+                    widget, end = JSON_DECODER.raw_decode(dbody, pos)
+                    widgets.append(RawWidget(dbody[pos:end], widget, row_volumes))
+                    pos = JSON_WHITESPACE.match(dbody, end).end()
+                    if dbody[pos:pos + 1] != ",":
+                        break
+                    pos = expect_json(dbody, pos, ",")
+                pos = expect_json(dbody, pos, "]")
+        pos = JSON_WHITESPACE.match(dbody, pos).end()
+        if dbody[pos:pos + 1] != ",":
+            break
+        pos = expect_json(dbody, pos, ",")
+    expect_json(dbody, pos, "}")
+    return widgets
+
+def expect_json(dbody: str, pos: int, token: str):
+    """skip whitespaces and the token
+
+    Args:
+        dbody (str): JSON
+        pos (int): position to start
+        token (str): expected character
+
+    Returns:
+        int: position after the token and whitespaces
+
+    Raises:
+        json.JSONDecodeError: the token is not found
+    """
+    pos = JSON_WHITESPACE.match(dbody, pos).end()
+    if dbody[pos:pos + 1] != token:
+        raise json.JSONDecodeError("Expecting '{0}'".format(token), dbody, pos)
+    return JSON_WHITESPACE.match(dbody, pos + 1).end()
+
+def decode_widget(widget):
+    """decode widget to change it
+
+    Args:
+        widget: dict or RawWidget
+
+    Returns:
+        dict: widget
+    """
+    if isinstance(widget, RawWidget):
+        return json.loads(widget.raw)
+    return widget
+
+def widget_summary(widget):
+    """title and number of metrics rows of widget
+
+    Args:
+        widget: dict or RawWidget
+
+    Returns:
+        tuple: (title, number of metrics rows)
+    """
+    if isinstance(widget, RawWidget):
+        return widget.title, widget.nrows
+    # widgets other than metric widget may have no title or metrics
+    properties = widget.get("properties") or {}
+    return properties.get("title") or "", len(properties.get("metrics") or [])
+
+def widget_series(widget, row_volumes=None):
+    """VolumeIds and metrics ids of rows of widget
+
+    Args:
+        widget: dict or RawWidget
+        row_volumes (optional): see volume_locations().
+            RawWidget uses row_volumes given to split_widgets().
+
+    Returns:
+        list: [(VolumeIds, metrics ids)]. see row_series()
+    """
+    if isinstance(widget, RawWidget):
+        return widget.series
+    return row_series(widget["properties"]["metrics"], row_volumes)
+
+def dump_widgets(widgets: list):
+    """serialize widgets to DashboardBody
+
+    RawWidget is spliced as its JSON fragment without encoding.
+
+    Args:
+        widgets (list): dict or RawWidget
+
+    Returns:
+        str: DashboardBody same as dumps_json({"widgets": widgets})
+    """
+    return '{{"widgets":[{0}]}}'.format(",".join([
+        widget.raw if isinstance(widget, RawWidget) else dumps_json(widget)
+        for widget in widgets]))
+
+def dumps_json(obj):
+    """serialize object to compact JSON of DashboardBody
+
+    Non-ASCII characters are escaped so that length of the JSON is its bytes.
+    Bodies of dump_dashboard() may not be, because RawWidget fragments
+    are spliced as read and can hold raw UTF-8. Encode them to count bytes.
+
+    Args:
+        obj: object
+
+    Returns:
+        str: JSON
+    """
+    return json.dumps(obj, separators=JSON_SEPARATORS)
+
+def new_dashboard(dbname: str, target: tuple):
+    """create empty dashboard model
+
+    Args:
+        dbname (str): dashboard name
+        target (tuple): (region, account) of volumes. account is None in home account
+
+    Returns:
+        dict: dashboard model
+            {"name": dashboard name,
+             "widgets": widgets which are not managed by this script,
+             "reged_widgets": {metrics name: widget index},
+             "totalmetrics": number of registered metrics,
+             "size": bytes of DashboardBody,
+             "digest": digest of DashboardBody read. None if not exists,
+             "read_at": time.monotonic() when the digest was read. None if never read,
+             "pending": [VolumeId added but not put yet],
+             "removed": {VolumeId removed but not put yet},
+             "target": (region, account) of volumes}
+    """
+    return {"name": dbname,
+            "widgets": [],
+            "reged_widgets": {key: widget_index() for key in METRICS_TEMPLATE.keys()},
+            "totalmetrics": 0,
+            "size": len(dumps_json({"widgets": []})),
+            "digest": None,
+            "read_at": None,
+            "pending": [],
+            "removed": set(),
+            "target": target}
+
+def dashboard_volumes(dashboard: dict):
+    """VolumeIds registered to dashboard model in registered order
+
+    Args:
+        dashboard (dict): dashboard model
+
+    Returns:
+        list: VolumeIds
+    """
+    volids = dict()
+    for windex in dashboard["reged_widgets"].values():
+        for widget in windex["widgets"]:
+            for rowvols, _ in widget_series(widget, search_volumes):
+                volids.update(dict.fromkeys(rowvols))
+    return list(volids)
+
+def registered_volumes(dashboard: dict):
+    """VolumeIds registered to dashboard model
+
+    Args:
+        dashboard (dict): dashboard model
+
+    Returns:
+        set: VolumeIds
+    """
+    return set(dashboard_volumes(dashboard))
+
+def has_volumes(dashboard: dict, volids: list):
+    """checks dashboard model whether metrics of all volumes are registered
+
+    With SEARCH_SCOPE_ALL, volumes are registered if widgets of all metrics exist.
+
+    Args:
+        dashboard (dict): dashboard model
+        volids (list): VolumeIds
+
+    Returns:
+        bool: True if all volumes are registered
+    """
+    if WIDGET_MODE == WIDGET_MODE_SEARCH and SEARCH_SCOPE == SEARCH_SCOPE_ALL:
+        return all([windex["widgets"] for windex in dashboard["reged_widgets"].values()])
+    return set(volids) <= registered_volumes(dashboard)
+
+def dashboard_locations(dashboard: dict, volids: set=None):
+    """reverse index entries of volumes registered to dashboard model
+
+    Args:
+        dashboard (dict): dashboard model
+        volids (set, optional): VolumeIds to locate. All volumes if None.
+
+    Returns:
+        dict: {VolumeId: location}. see dedupe_store.volume_location()
+    """
+    return volume_locations(dashboard["name"], dashboard["reged_widgets"], volids, search_volumes)
+
+def free_volumes(dashboard: dict):
+    """number of volumes which can be registered to dashboard model more
+
+    Args:
+        dashboard (dict): dashboard model
+
+    Returns:
+        int: number of volumes
+    """
+    return volumes_fit(MAX_METRICS_DBOARD - dashboard["totalmetrics"],
+                       MAX_DBOARD_BYTES - dashboard["size"])
+
+def volumes_fit(rows: int, nbytes: int):
+    """number of volumes which fit in free rows and bytes of dashboard
+
+    Args:
+        rows (int): free metrics rows
+        nbytes (int): free bytes of DashboardBody
+
+    Returns:
+        int: number of volumes. infinity if SEARCH expressions match all volumes.
+    """
+    if WIDGET_MODE != WIDGET_MODE_SEARCH:
+        return max(0, min(rows // VOLUME_ROWS, nbytes // (VOLUME_ROWS * ESTIMATED_ROW_BYTES)))
+    if SEARCH_SCOPE == SEARCH_SCOPE_ALL:
+        return float("inf")
+    # a new row may be needed per metrics
+    by_rows = (rows - len(METRICS_TEMPLATE)) // len(METRICS_TEMPLATE) * SEARCH_IDS_PER_ROW
+    by_bytes = (nbytes - len(METRICS_TEMPLATE) * MAX_SEARCH_LENGTH) // (len(METRICS_TEMPLATE) * SEARCH_ID_BYTES)
+    return max(0, min(by_rows, by_bytes))
+
+def is_limit_dashboard(dashboard: dict, plan: tuple=None):
+    """checks dashboard whether it register metrics of one more volume
+
+    Args:
+        dashboard (dict): dashboard model
+        plan (tuple, optional): plan_volume() of the volume.
+            Rows and bytes of the volume are checked exactly if given.
+    """
+    if plan is None:
+        return free_volumes(dashboard) < 1
+    _, rows, nbytes = plan
+    return dashboard["totalmetrics"] + rows > MAX_METRICS_DBOARD \
+        or dashboard["size"] + nbytes > MAX_DBOARD_BYTES
+
+def pack_volumes(dashboards: list, volids: list, next_shard):
+    """place volumes to dashboards with first fit
+
+    Volumes are placed to the first dashboard having free space
+    and new dashboards are created after the last one.
+
+    Args:
+        dashboards (list): dashboard models ordered by numeric suffix
+        volids (list): VolumeIds
+        next_shard: function returns dashboard model of the next name
+
+    Returns:
+        tuple: ([dashboard model touched], {VolumeId: dashboard name})
+    """
+    placed = dict()
+    touched = list()
+    dashboards = list(dashboards)
+    i = 0
+    for volid in volids:
+        plan = plan_volume(dashboards[i], volid)
+        while is_limit_dashboard(dashboards[i], plan):
+            i += 1
+            if i == len(dashboards):
+                dashboards.append(next_shard(dashboards[-1]["name"]))
+                logger.info("Create a new dashboard {0}".format(dashboards[-1]["name"]))
+                registrar_metrics.count("ShardRollovers")
+            plan = plan_volume(dashboards[i], volid)
+        add_volume_to_dashboard(dashboards[i], volid, plan)
+        placed[volid] = dashboards[i]["name"]
+        if not touched or touched[-1] is not dashboards[i]:
+            touched.append(dashboards[i])
+    return touched, placed
+
+def plan_volume(dashboard: dict, volid: str):
+    """plan changes of widgets to add metrics of the volume to dashboard model
+
+    Bytes are exact growth of DashboardBody serialized by dump_dashboard().
+
+    Args:
+        dashboard (dict): dashboard model
+        volid (str): VolumeId
+
+    Returns:
+        tuple: ([(metrics name, action, item)], rows added, bytes added)
+            see plan_metrics_volume() and plan_search_volume() for action and item.
+    """
+    nwidgets = len(dashboard["widgets"]) + sum([len(windex["widgets"])
+                                                for windex in dashboard["reged_widgets"].values()])
+    changes = list()
+    rows = 0
+    nbytes = 0
+    for key, windex in dashboard["reged_widgets"].items():
+        if WIDGET_MODE == WIDGET_MODE_SEARCH:
+            action, item = plan_search_volume(windex, key, volid, dashboard["target"])
+        else:
+            action, item = plan_metrics_volume(windex, key, volid, dashboard["target"])
+        if action is None:
+            continue
+        if action == "expression":
+            last = windex["widgets"][-1]["properties"]["metrics"][-1][0]["expression"]
+            nbytes += len(dumps_json(item)) - len(dumps_json(last))
+        elif action == "rows":
+            # separator is not needed before first row
+            first = 1 if windex["widgets"][-1]["properties"]["metrics"] else 0
+            nbytes += sum([len(dumps_json(row)) + 1 for row in item]) - 1 + first
+            rows += len(item)
+        else:
+            nbytes += len(dumps_json(item)) + (1 if nwidgets else 0)
+            nwidgets += 1
+            rows += len(item["properties"]["metrics"])
+        changes.append((key, action, item))
+    return changes, rows, nbytes
+
+def plan_metrics_volume(windex: dict, key: str, volid: str, target: tuple):
+    """plan m/e rows of the volume added to last widget of the widget index
+
+    Args:
+        windex (dict): widget index. see widget_index()
+        key (str): metrics name
+        volid (str): VolumeId
+        target (tuple): (region, account) of the volume. see new_dashboard()
+
+    Returns:
+        tuple: ("rows", [metrics row]) or ("widget", new widget)
+    """
+    metrics = [{"DimensionName": key, "VolumeId": volid, "AccountId": target[1]}]
+    widgets = windex["widgets"]
+    # create a next widget if its does not exists or is over limitation
+    if not widgets or is_limit_regmetrics(widgets[-1], metrics):
+        return "widget", create_widget(widget_title(key, windex["number"] + 1), metrics,
+                                       region=target[0])
+    return "rows", metric_rows(metrics[0], windex["nextid"])
+
+def search_expression(key: str, volids: list=None):
+    """SEARCH expression of metrics per second of volumes
+
+    Args:
+        key (str): metrics name
+        volids (list, optional): VolumeIds. All volumes are searched if None.
+
+    Returns:
+        str: expression
+    """
+    if volids is None:
+        scope = " {0}".format(SEARCH_FILTER) if SEARCH_FILTER else ""
+    else:
+        scope = " AND ({0})".format(" OR ".join(['VolumeId="{0}"'.format(volid) for volid in volids]))
+    return SEARCH_TEMPLATE.format(key, scope)
+
+def search_volumes(row: list):
+    """VolumeIds in SEARCH expression of metrics row
+
+    Args:
+        row (list): metrics row of widget
+
+    Returns:
+        list: VolumeIds. None if row is not SEARCH expression.
+    """
+    if not isinstance(row[0], dict) or not row[0].get("expression", "").startswith("SEARCH("):
+        return None
+    return SEARCH_VOLUME_PATTERN.findall(row[0]["expression"])
+
+def search_row(key: str, volids: list, rowid: int, account: str=None):
+    """create metrics row of SEARCH expression
+
+    Args:
+        key (str): metrics name
+        volids (list): VolumeIds. All volumes are searched if None.
+        rowid (int): id number of row
+        account (str, optional): account of volumes if it is other account
+
+    Returns:
+        list: metrics row
+    """
+    row = {"expression": search_expression(key, volids),
+           "label": SEARCH_LABEL,
+           "id": "e{0}".format(rowid)}
+    if account:
+        row["accountId"] = account
+    return [row]
+
+def plan_search_volume(windex: dict, key: str, volid: str, target: tuple):
+    """plan SEARCH expression of last widget of the widget index to add VolumeId
+
+    VolumeId is added to the last expression until it reaches MAX_SEARCH_LENGTH.
+    With SEARCH_SCOPE_ALL, widget is changed only when it does not exist.
+
+    Args:
+        windex (dict): widget index. see widget_index()
+        key (str): metrics name
+        volid (str): VolumeId
+        target (tuple): (region, account) of the volume. see new_dashboard()
+
+    Returns:
+        tuple: ("expression", new expression of last row), ("rows", [metrics row])
+            or ("widget", new widget). (None, None) if widget index is not changed.
+    """
+    volids = None if SEARCH_SCOPE == SEARCH_SCOPE_ALL else [volid]
+    widgets = windex["widgets"]
+    if widgets and widgets[-1]["properties"]["metrics"]:
+        rows = widgets[-1]["properties"]["metrics"]
+        reged = search_volumes(rows[-1])
+        if reged is not None and volids is None:
+            return None, None
+        if reged:
+            expression = search_expression(key, reged + volids)
+            if len(expression) <= MAX_SEARCH_LENGTH:
+                return "expression", expression
+        if len(rows) < SEARCH_ROWS_WIDGET:
+            return "rows", [search_row(key, volids, windex["nextid"], target[1])]
+    widget = create_widget(widget_title(key, windex["number"] + 1), region=target[0])
+    widget["properties"]["metrics"].append(search_row(key, volids, 1, target[1]))
+    return "widget", widget
+
+def add_volume_to_dashboard(dashboard: dict, volid: str, plan: tuple=None):
+    """add metrics of the volume to dashboard model
+
+    Args:
+        dashboard (dict): dashboard model
+        volid (str): VolumeId
+        plan (tuple, optional): plan_volume() of the volume
+    """
+    changes, rows, nbytes = plan if plan is not None else plan_volume(dashboard, volid)
+    if not changes:
+        return
+    for key, action, item in changes:
+        windex = dashboard["reged_widgets"][key]
+        if action == "expression":
+            windex["widgets"][-1]["properties"]["metrics"][-1][0]["expression"] = item
+        elif action == "rows":
+            windex["widgets"][-1]["properties"]["metrics"].extend(item)
+            windex["nextid"] += 1
+        else:
+            windex["widgets"].append(item)
+            windex["number"] += 1
+            windex["nextid"] = 2
+    dashboard["totalmetrics"] += rows
+    dashboard["size"] += nbytes
+    registrar_metrics.count("MetricsAppended", rows)
+    dashboard["pending"].append(volid)
+
+def remove_volumes_from_dashboard(dashboard: dict, volids: set):
+    """remove metrics of the volumes from dashboard model
+
+    Ids of remaining metrics are not changed and empty widgets are removed.
+    Widgets having none of the volumes are kept without decoding.
+
+    Args:
+        dashboard (dict): dashboard model
+        volids (set): VolumeIds
+
+    Returns:
+        set: VolumeIds removed
+    """
+    removed = set()
+    widgets = list(dashboard["widgets"])
+    for key, windex in dashboard["reged_widgets"].items():
+        for widget in windex["widgets"]:
+            if volids.isdisjoint([volid for rowvols, _ in widget_series(widget, search_volumes)
+                                  for volid in rowvols]):
+                if widget_summary(widget)[1]:
+                    widgets.append(widget)
+                continue
+            widget = decode_widget(widget)
+            rows = widget["properties"]["metrics"]
+            ids = set()
+            for row in rows:
+                if len(row) > 3 and row[2] == "VolumeId":
+                    if row[3] in volids:
+                        removed.add(row[3])
+                        ids.add(row[-1]["id"][1:])
+                    continue
+                reged = search_volumes(row)
+                if not reged or volids.isdisjoint(reged):
+                    continue
+                removed.update(volids.intersection(reged))
+                remaining = [volid for volid in reged if volid not in volids]
+                if remaining:
+                    row[0]["expression"] = search_expression(key, remaining)
+                else:
+                    ids.add(row[-1]["id"][1:])
+            if ids:
+                widget["properties"]["metrics"] = [row for row in rows
+                                                   if row[-1]["id"][1:] not in ids]
+            if widget["properties"]["metrics"]:
+                widgets.append(widget)
+    if removed:
+        dashboard["widgets"], dashboard["reged_widgets"], dashboard["totalmetrics"] = \
+            index_widgets(widgets)
+        dashboard["size"] = len(dump_dashboard(dashboard).encode("utf-8"))
+        dashboard["removed"] |= removed
+    return removed
+
+def dump_dashboard(dashboard: dict):
+    """serialize dashboard model to DashboardBody
+
+    Args:
+        dashboard (dict): dashboard model
+
+    Returns:
+        str: DashboardBody
+    """
+    widgets = list(dashboard["widgets"])
+    for key in dashboard["reged_widgets"].keys():
+        widgets.extend(dashboard["reged_widgets"][key]["widgets"])
+    with registrar_metrics.timer("SerializeTime"):
+        return dump_widgets(widgets)
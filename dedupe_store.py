@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import threading
+
+"""
+登録済みボリュームの逆引きインデックスを記録するストア
+
+ダッシュボードに書き込んだ VolumeId ごとに、登録先のダッシュボード名と
+ウィジェットのタイトル, メトリクスの id (mN/eN) を記録する。
+SQS の再配信や EventBridge のリトライによる重複登録の防止と、
+全ダッシュボードを読まずにボリュームの登録先を探すのに使う。
+重複登録の防止に使う期限と登録先を探すのに使う期限は別に設定する。
+メモリ, ローカルファイル (JSON Lines の変更履歴), SQLite から選択する。
+"""
+
+
+# seconds to skip registration of volumes recorded. 0 never expires
+DEDUPE_TTL = int(os.getenv('DEDUPE_TTL', '86400'))
+# seconds to remember where volumes are registered. 0 keeps them until they are
+# removed or rebuilt, because deleteVolume events may come long after registration.
+# stale locations only make deregistration read the dashboard first
+LOCATION_TTL = int(os.getenv('LOCATION_TTL', '0'))
+# changes appended to FileStore before it is rewritten, at least
+FILE_COMPACT_MIN = 1000
+
+def expiry(ttl: int):
+    """oldest time of entries not expired
+
+    Args:
+        ttl (int): seconds. 0 never expires
+
+    Returns:
+        float: entries updated after this are not expired
+    """
+    return time.time() - ttl if ttl > 0 else 0
+
+def volume_location(dbname: str, series: list=None):
+    """create reverse index entry of a volume
+
+    Args:
+        dbname (str): dashboard name
+        series (list, optional): [[widget title, id of metrics row, ...]]
+
+    Returns:
+        dict: location {"dashboard": dashboard name, "series": [[widget title, ids...]]}
+    """
+    return {"dashboard": dbname, "series": series or []}
+
+class MemoryStore:
+    """reverse index in memory of warm container
+
+    Args:
+        ttl (int, optional): seconds to skip registration of volumes
+        location_ttl (int, optional): seconds to remember locations of volumes
+    """
+
+    def __init__(self, ttl: int=DEDUPE_TTL, location_ttl: int=LOCATION_TTL):
+        self.ttl = ttl
+        self.location_ttl = location_ttl
+        # {dashboard name prefix: {VolumeId: [location, registered time]}}
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+    def _find(self, dbname_prefix: str, volids: list, ttl: int):
+        expires = expiry(ttl)
+        with self.lock:
+            entries = self.entries.get(dbname_prefix, {})
+            return {volid: entries[volid][0] for volid in volids
+                    if volid in entries and entries[volid][1] > expires}
+
+    def locate(self, dbname_prefix: str, volids: list):
+        """locations of registered volumes within location_ttl
+
+        Args:
+            dbname_prefix (str): dashboard name prefix
+            volids (list): VolumeIds
+
+        Returns:
+            dict: {VolumeId: location} of registered volumes. see volume_location()
+        """
+        return self._find(dbname_prefix, volids, self.location_ttl)
+
+    def registered(self, dbname_prefix: str, volids: list):
+        """dashboards which volumes were registered to within ttl
+
+        Args:
+            dbname_prefix (str): dashboard name prefix
+            volids (list): VolumeIds
+
+        Returns:
+            dict: {VolumeId: dashboard name} of registered volumes
+        """
+        return {volid: location["dashboard"]
+                for volid, location in self._find(dbname_prefix, volids, self.ttl).items()}
+
+    def update(self, dbname_prefix: str, locations: dict, removed: list=()):
+        """apply volumes added to and removed from a dashboard at once
+
+        Args:
+            dbname_prefix (str): dashboard name prefix
+            locations (dict): {VolumeId: location} of volumes registered
+            removed (list, optional): VolumeIds removed
+        """
+        if not locations and not removed:
+            return
+        now = time.time()
+        with self.lock:
+            entries = self.entries.setdefault(dbname_prefix, dict())
+            for volid in removed:
+                entries.pop(volid, None)
+            changed = {volid: [location, now] for volid, location in locations.items()}
+            entries.update(changed)
+            self.save(dbname_prefix, changed, removed)
+
+    def add(self, dbname_prefix: str, locations: dict):
+        """remember volumes registered to dashboards
+
+        Args:
+            dbname_prefix (str): dashboard name prefix
+            locations (dict): {VolumeId: location}
+        """
+        self.update(dbname_prefix, locations)
+
+    def remove(self, dbname_prefix: str, volids: list):
+        """forget volumes removed from dashboards
+
+        Args:
+            dbname_prefix (str): dashboard name prefix
+            volids (list): VolumeIds
+        """
+        self.update(dbname_prefix, dict(), volids)
+
+    def rebuild(self, dbname_prefix: str, locations: dict):
+        """replace all volumes of the prefix with a full scan of dashboards
+
+        Args:
+            dbname_prefix (str): dashboard name prefix
+            locations (dict): {VolumeId: location} of all volumes
+        """
+        now = time.time()
+        with self.lock:
+            self.entries[dbname_prefix] = {volid: [location, now]
+                                           for volid, location in locations.items()}
+            self.save(dbname_prefix, self.entries[dbname_prefix], rebuild=True)
+
+    def save(self, dbname_prefix: str, entries: dict, removed: list=(), rebuild: bool=False):
+        """persist a change of entries. called with lock held
+
+        Args:
+            dbname_prefix (str): dashboard name prefix
+            entries (dict): {VolumeId: [location, registered time]} changed
+            removed (list, optional): VolumeIds removed
+            rebuild (bool, optional): entries replace all volumes of the prefix
+        """
+        pass
+
+class FileStore(MemoryStore):
+    """reverse index saved to local file
+
+    Each change is appended to the file as a JSON line, and the file is
+    rewritten with current entries when changes outnumber them.
+    Expired entries are dropped when the file is loaded.
+
+    Args:
+        path (str): file path
+        ttl (int, optional): seconds to skip registration of volumes
+        location_ttl (int, optional): seconds to remember locations of volumes
+    """
+
+    def __init__(self, path: str, ttl: int=DEDUPE_TTL, location_ttl: int=LOCATION_TTL):
+        super().__init__(ttl, location_ttl)
+        self.path = path
+        self.changes = 0
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        """replay changes in the file"""
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    # the last line may be broken if writing it was interrupted
+                    continue
+                self.changes += 1
+                if "prefix" not in change:
+                    # whole entries written by older versions
+                    self.entries.update(change)
+                elif change["rebuild"]:
+                    self.entries[change["prefix"]] = change["entries"]
+                else:
+                    entries = self.entries.setdefault(change["prefix"], dict())
+                    for volid in change["removed"]:
+                        entries.pop(volid, None)
+                    entries.update(change["entries"])
+        # entries are kept while either of ttls keeps them
+        expires = min(expiry(self.ttl), expiry(self.location_ttl))
+        for entries in self.entries.values():
+            for volid in [volid for volid, entry in entries.items() if entry[1] <= expires]:
+                del entries[volid]
+
+    def save(self, dbname_prefix: str, entries: dict, removed: list=(), rebuild: bool=False):
+        if self.changes >= max(FILE_COMPACT_MIN, sum(len(volumes) for volumes in self.entries.values())):
+            self.compact()
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"prefix": dbname_prefix, "rebuild": rebuild,
+                                "entries": entries, "removed": list(removed)},
+                               separators=(",", ":")) + "\n")
+        self.changes += 1
+
+    def compact(self):
+        """rewrite the file with current entries. called with lock held"""
+        # write whole file and replace it not to leave broken file
+        tmp = "{0}.tmp".format(self.path)
+        with open(tmp, "w") as f:
+            for dbname_prefix, entries in self.entries.items():
+                f.write(json.dumps({"prefix": dbname_prefix, "rebuild": True,
+                                    "entries": entries, "removed": []},
+                                   separators=(",", ":")) + "\n")
+        os.replace(tmp, self.path)
+        self.changes = 0
+
+class SQLiteStore:
+    """reverse index saved to SQLite database
+
+    Each change is committed in a transaction.
+
+    Args:
+        path (str): database file path
+        ttl (int, optional): seconds to skip registration of volumes
+        location_ttl (int, optional): seconds to remember locations of volumes
+    """
+
+    def __init__(self, path: str, ttl: int=DEDUPE_TTL, location_ttl: int=LOCATION_TTL):
+        # sqlite3 is imported on use not to slow down cold start of other stores
+        import sqlite3
+        self.ttl = ttl
+        self.location_ttl = location_ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS locations ("
+                              "prefix TEXT NOT NULL, volid TEXT NOT NULL, "
+                              "dbname TEXT NOT NULL, series TEXT NOT NULL, updated REAL NOT NULL, "
+                              "PRIMARY KEY (prefix, volid))")
+
+    def _find(self, dbname_prefix: str, volids: list, ttl: int):
+        expires = expiry(ttl)
+        found = dict()
+        volids = list(volids)
+        with self.lock:
+            # keep number of parameters under the limit of sqlite
+            for i in range(0, len(volids), 500):
+                chunk = volids[i:i + 500]
+                rows = self.conn.execute(
+                    "SELECT volid, dbname, series FROM locations WHERE prefix = ? AND updated > ? "
+                    "AND volid IN ({0})".format(",".join("?" * len(chunk))),
+                    [dbname_prefix, expires] + chunk)
+                for volid, dbname, series in rows:
+                    found[volid] = volume_location(dbname, json.loads(series))
+        return found
+
+    def locate(self, dbname_prefix: str, volids: list):
+        return self._find(dbname_prefix, volids, self.location_ttl)
+
+    def registered(self, dbname_prefix: str, volids: list):
+        return {volid: location["dashboard"]
+                for volid, location in self._find(dbname_prefix, volids, self.ttl).items()}
+
+    def _insert(self, dbname_prefix: str, locations: dict):
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?)",
+                              [(dbname_prefix, volid, location["dashboard"],
+                                json.dumps(location["series"], separators=(",", ":")), now)
+                               for volid, location in locations.items()])
+
+    def update(self, dbname_prefix: str, locations: dict, removed: list=()):
+        if not locations and not removed:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM locations WHERE prefix = ? AND volid = ?",
+                                  [(dbname_prefix, volid) for volid in removed])
+            self._insert(dbname_prefix, locations)
+
+    def add(self, dbname_prefix: str, locations: dict):
+        self.update(dbname_prefix, locations)
+
+    def remove(self, dbname_prefix: str, volids: list):
+        self.update(dbname_prefix, dict(), volids)
+
+    def rebuild(self, dbname_prefix: str, locations: dict):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM locations WHERE prefix = ?", (dbname_prefix,))
+            self._insert(dbname_prefix, locations)
+
+def open_store(url: str):
+    """create reverse index store from url
+
+    Args:
+        url (str): "memory", "file:<path>" or "sqlite:<path>"
+
+    Returns:
+        reverse index store
+    """
+    kind, _, path = url.partition(":")
+    if kind == "memory":
+        return MemoryStore()
+    if kind == "file":
+        return FileStore(path)
+    if kind == "sqlite":
+        return SQLiteStore(path)
+    raise ValueError("Unknown dedupe store: {0}".format(url))
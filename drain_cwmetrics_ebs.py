@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import logging
+import argparse
+import aws_clients
+import registrar_metrics
+from dashboard_io import init_cwclient
+from register_cwmetrics_ebs_viasqs import process_records
+
+"""
+SQS に溜まったボリュームイベントをまとめて CloudWatch ダッシュボードに反映する
+
+キューをロングポーリングで受信し、時間または件数のウィンドウ内のイベントを
+まとめてダッシュボードごとに 1 回だけ書き込む。書き込みに成功したメッセージだけを削除する。
+スケジュール実行の Lambda か、ローカルで常駐するワーカーとして実行する。
+"""
+
+
+QUEUE_URL = os.getenv('QUEUE_URL')
+DRAIN_WINDOW = float(os.getenv('DRAIN_WINDOW', '20'))
+DRAIN_MAX_MESSAGES = int(os.getenv('DRAIN_MAX_MESSAGES', '5000'))
+RECEIVE_WAIT_TIME = int(os.getenv('RECEIVE_WAIT_TIME', '20'))
+# messages must stay invisible until dashboards of a window are written
+VISIBILITY_TIMEOUT = int(os.getenv('VISIBILITY_TIMEOUT', '300'))
+# stop lambda when remaining time is less than this
+LAMBDA_MARGIN = float(os.getenv('LAMBDA_MARGIN', '60'))
+MAX_RECEIVE_MESSAGES = 10
+MAX_DELETE_MESSAGES = 10
+
+# reused across warm invocations
+sqsclients = dict()
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+
+def init_sqsclient(region: str=None):
+    """initialize boto3 sqs client
+
+    Client is created once per region and reused across warm invocations.
+
+    Args:
+        region (str, optional): region name. Defaults to lambda region.
+
+    Returns:
+        boto3.client: sqs client object
+    """
+    if region not in sqsclients:
+        sqsclients[region] = aws_clients.create_client("sqs", region)
+    return sqsclients[region]
+
+def receive_window(sqs, queue_url: str, window: float=DRAIN_WINDOW,
+                   max_messages: int=DRAIN_MAX_MESSAGES):
+    """receive messages until the window elapses or the queue becomes empty
+
+    Args:
+        sqs (boto3.client): sqs client
+        queue_url (str): queue url
+        window (float, optional): seconds to receive messages
+        max_messages (int, optional): number of messages to stop receiving
+
+    Returns:
+        list: Messages of receive_message. Duplicated deliveries are removed.
+    """
+    messages = dict()
+    deadline = time.time() + window
+    while len(messages) < max_messages:
+        wait = int(min(RECEIVE_WAIT_TIME, max(0, deadline - time.time())))
+        with registrar_metrics.timer("ReceiveMessageTime"):
+            res = sqs.receive_message(QueueUrl=queue_url,
+                                      MaxNumberOfMessages=min(MAX_RECEIVE_MESSAGES,
+                                                              max_messages - len(messages)),
+                                      WaitTimeSeconds=wait,
+                                      VisibilityTimeout=VISIBILITY_TIMEOUT)
+        registrar_metrics.count("ReceiveMessageCalls")
+        received = res.get("Messages", [])
+        # long polling returned nothing, the queue is drained
+        if not received:
+            break
+        for message in received:
+            messages[message["MessageId"]] = message
+        if time.time() >= deadline:
+            break
+    return list(messages.values())
+
+def delete_messages(sqs, queue_url: str, messages: list):
+    """delete messages with delete_message_batch
+
+    Args:
+        sqs (boto3.client): sqs client
+        queue_url (str): queue url
+        messages (list): Messages of receive_message
+
+    Returns:
+        list: MessageIds failed to delete
+    """
+    failed = list()
+    for i in range(0, len(messages), MAX_DELETE_MESSAGES):
+        chunk = messages[i:i + MAX_DELETE_MESSAGES]
+        entries = [{"Id": str(j), "ReceiptHandle": message["ReceiptHandle"]}
+                   for j, message in enumerate(chunk)]
+        try:
+            res = sqs.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+        except (aws_clients.BotoCoreError,
+                aws_clients.ClientError) as e:
+            logger.error("Failed to delete messages: {0}".format(e))
+            failed.extend([message["MessageId"] for message in chunk])
+            continue
+        registrar_metrics.count("DeleteMessageBatchCalls")
+        for entry in res.get("Failed", []):
+            logger.error("Failed to delete message {0}: {1}".format(
+                chunk[int(entry["Id"])]["MessageId"], entry.get("Message")))
+            failed.append(chunk[int(entry["Id"])]["MessageId"])
+    return failed
+
+def drain(sqs, client, queue_url: str, dbname_prefix: str,
+          window: float=DRAIN_WINDOW, max_messages: int=DRAIN_MAX_MESSAGES):
+    """apply volume events received in a window to dashboards
+
+    Messages which were not applied are left in the queue
+    and received again after VISIBILITY_TIMEOUT.
+
+    Args:
+        sqs (boto3.client): sqs client
+        client (boto3.client): cloudwatch client
+        queue_url (str): queue url
+        dbname_prefix (str): dashboard name prefix
+        window (float, optional): seconds to receive messages
+        max_messages (int, optional): number of messages per window
+
+    Returns:
+        dict: summary of the window
+    """
+    messages = receive_window(sqs, queue_url, window, max_messages)
+    if not messages:
+        return {"received": 0, "deleted": 0, "failed": [], "results": []}
+    logger.info("Received {0} messages from {1}".format(len(messages), queue_url))
+    records = [{"messageId": message["MessageId"], "body": message["Body"]}
+               for message in messages]
+    results, failures = process_records(client, dbname_prefix, records)
+    failures = set(failures)
+    committed = [message for message in messages if message["MessageId"] not in failures]
+    failed_delete = delete_messages(sqs, queue_url, committed)
+    registrar_metrics.count("Records", len(messages))
+    registrar_metrics.count("FailedRecords", len(failures))
+    return {"received": len(messages),
+            "deleted": len(committed) - len(failed_delete),
+            "failed": sorted(failures),
+            "results": results}
+
+def run_worker(sqs, client, queue_url: str, dbname_prefix: str,
+               window: float=DRAIN_WINDOW, max_messages: int=DRAIN_MAX_MESSAGES,
+               forever: bool=False, until=None):
+    """drain the queue window by window
+
+    Args:
+        sqs (boto3.client): sqs client
+        client (boto3.client): cloudwatch client
+        queue_url (str): queue url
+        dbname_prefix (str): dashboard name prefix
+        window (float, optional): seconds to receive messages
+        max_messages (int, optional): number of messages per window
+        forever (bool, optional): keep polling after the queue becomes empty
+        until (optional): function returns True to stop
+
+    Returns:
+        dict: summary of all windows
+    """
+    total = {"windows": 0, "received": 0, "deleted": 0, "failed": []}
+    while True:
+        start = time.perf_counter()
+        registrar_metrics.reset()
+        summary = drain(sqs, client, queue_url, dbname_prefix, window, max_messages)
+        if summary["received"]:
+            registrar_metrics.count("HandlerTime", (time.perf_counter() - start) * 1000,
+                                    registrar_metrics.UNIT_MILLISECONDS)
+            registrar_metrics.emit({"DashboardPrefix": str(dbname_prefix)})
+            total["windows"] += 1
+            total["received"] += summary["received"]
+            total["deleted"] += summary["deleted"]
+            total["failed"].extend(summary["failed"])
+        if not forever and not summary["received"]:
+            break
+        if until is not None and until():
+            break
+    return total
+
+def lambda_handler(event, context):
+    queue_url = event.get('queue_url', QUEUE_URL)
+    dbname_prefix = event.get('prefix', os.getenv('DBOARD_PREFIX'))
+    window = float(event.get('window', DRAIN_WINDOW))
+
+    def until():
+        return context.get_remaining_time_in_millis() / 1000 < window + LAMBDA_MARGIN
+
+    total = run_worker(init_sqsclient(), init_cwclient(), queue_url, dbname_prefix,
+                       window, int(event.get('max_messages', DRAIN_MAX_MESSAGES)),
+                       until=until if context else None)
+    return {"result": total,
+            "responsecode": 200 if not total["failed"] else -1}
+
+def main():
+    parser = argparse.ArgumentParser(description="Drain EBS volume events from SQS to dashboards")
+    parser.add_argument("--queue-url", default=QUEUE_URL, help="queue url")
+    parser.add_argument("--prefix", default=os.getenv('DBOARD_PREFIX'),
+                        help="dashboard name prefix")
+    parser.add_argument("--region", help="region name")
+    parser.add_argument("--window", type=float, default=DRAIN_WINDOW,
+                        help="seconds to coalesce events")
+    parser.add_argument("--max-messages", type=int, default=DRAIN_MAX_MESSAGES,
+                        help="number of messages per window")
+    parser.add_argument("--forever", action="store_true",
+                        help="keep polling after the queue becomes empty")
+    args = parser.parse_args()
+    total = run_worker(init_sqsclient(args.region), init_cwclient(args.region),
+                       args.queue_url, args.prefix, args.window, args.max_messages,
+                       forever=args.forever)
+    print(json.dumps(total))
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    main()
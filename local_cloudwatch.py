@@ -0,0 +1,164 @@
+import json
+import time
+import random
+import datetime
+import threading
+import collections
+from botocore.exceptions import ClientError
+
+"""
+CloudWatch ダッシュボード API のローカルエミュレータ
+
+get_dashboard / put_dashboard / list_dashboards / delete_dashboards を
+メモリ上で再現する。ベンチマークや動作確認で boto3 クライアントの代わりに使う。
+"""
+
+
+MAX_WIDGETS = 500
+MAX_METRICS_WIDGET = 500
+MAX_METRICS_TOTAL = 2500
+MAX_BODY_BYTES = 1024 * 1024
+LIST_PAGE_SIZE = 1000
+
+def client_error(code: str, message: str, operation: str):
+    """create ClientError same as boto3 raises
+
+    Args:
+        code (str): error code
+        message (str): error message
+        operation (str): operation name
+
+    Returns:
+        ClientError: error object
+    """
+    return ClientError({"Error": {"Code": code, "Message": message},
+                        "ResponseMetadata": {"HTTPStatusCode": 400}},
+                       operation)
+
+class LocalCloudWatch:
+    """in-memory cloudwatch client which supports dashboard APIs
+
+    Args:
+        latency (float, optional): seconds to sleep on every API call
+        throttle_rate (float, optional): probability of ThrottlingException
+        max_tps (float, optional): calls per second of each API over which
+            ThrottlingException is raised. 0 is unlimited.
+        page_size (int, optional): number of entries per list_dashboards page
+        max_body_bytes (int, optional): limit of DashboardBody size
+        enforce_limits (bool, optional): reject DashboardBody over the limits
+    """
+
+    def __init__(self, latency: float=0.0, throttle_rate: float=0.0, max_tps: float=0.0,
+                 page_size: int=LIST_PAGE_SIZE, max_body_bytes: int=MAX_BODY_BYTES,
+                 enforce_limits: bool=True):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_tps = max_tps
+        # {operation: deque of call times in last second}
+        self.recent = collections.defaultdict(collections.deque)
+        self.page_size = page_size
+        self.max_body_bytes = max_body_bytes
+        self.enforce_limits = enforce_limits
+        self.dashboards = dict()
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+        # {dashboard name: number of puts}
+        self.puts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def _call(self, operation: str):
+        with self.lock:
+            self.calls[operation] += 1
+            if self.max_tps:
+                now = time.monotonic()
+                recent = self.recent[operation]
+                while recent and recent[0] <= now - 1.0:
+                    recent.popleft()
+                if len(recent) >= self.max_tps:
+                    self.throttled[operation] += 1
+                    raise client_error("Throttling", "Rate exceeded", operation)
+                recent.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            with self.lock:
+                self.throttled[operation] += 1
+            raise client_error("Throttling", "Rate exceeded", operation)
+
+    def _validate(self, dbody: str):
+        if len(dbody.encode("utf-8")) > self.max_body_bytes:
+            raise client_error("InvalidParameterInput",
+                               "DashboardBody exceeds {0} bytes".format(self.max_body_bytes),
+                               "PutDashboard")
+        try:
+            widgets = json.loads(dbody)["widgets"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise client_error("InvalidParameterInput", str(e), "PutDashboard")
+        if len(widgets) > MAX_WIDGETS:
+            raise client_error("InvalidParameterInput",
+                               "Dashboard has more than {0} widgets".format(MAX_WIDGETS),
+                               "PutDashboard")
+        total = 0
+        for widget in widgets:
+            metrics = widget.get("properties", {}).get("metrics", [])
+            if len(metrics) > MAX_METRICS_WIDGET:
+                raise client_error("InvalidParameterInput",
+                                   "Widget has more than {0} metrics".format(MAX_METRICS_WIDGET),
+                                   "PutDashboard")
+            total += len(metrics)
+        if total > MAX_METRICS_TOTAL:
+            raise client_error("InvalidParameterInput",
+                               "Dashboard has more than {0} metrics".format(MAX_METRICS_TOTAL),
+                               "PutDashboard")
+
+    def get_dashboard(self, DashboardName: str):
+        self._call("GetDashboard")
+        with self.lock:
+            dashboard = self.dashboards.get(DashboardName)
+        if dashboard is None:
+            raise client_error("ResourceNotFound",
+                               "Dashboard {0} does not exist".format(DashboardName),
+                               "GetDashboard")
+        return {"DashboardArn": "arn:aws:cloudwatch::000000000000:dashboard/{0}".format(DashboardName),
+                "DashboardBody": dashboard["DashboardBody"],
+                "DashboardName": DashboardName}
+
+    def put_dashboard(self, DashboardName: str, DashboardBody: str):
+        self._call("PutDashboard")
+        if self.enforce_limits:
+            self._validate(DashboardBody)
+        with self.lock:
+            self.puts[DashboardName] += 1
+            self.dashboards[DashboardName] = {
+                "DashboardBody": DashboardBody,
+                "LastModified": datetime.datetime.now(datetime.timezone.utc),
+                "Size": len(DashboardBody.encode("utf-8"))}
+        return {"DashboardValidationMessages": []}
+
+    def list_dashboards(self, DashboardNamePrefix: str="", NextToken: str=None):
+        self._call("ListDashboards")
+        with self.lock:
+            names = sorted(name for name in self.dashboards
+                           if name.startswith(DashboardNamePrefix))
+            start = int(NextToken or 0)
+            entries = [{"DashboardName": name,
+                        "DashboardArn": "arn:aws:cloudwatch::000000000000:dashboard/{0}".format(name),
+                        "LastModified": self.dashboards[name]["LastModified"],
+                        "Size": self.dashboards[name]["Size"]}
+                       for name in names[start:start + self.page_size]]
+        res = {"DashboardEntries": entries}
+        if start + self.page_size < len(names):
+            res["NextToken"] = str(start + self.page_size)
+        return res
+
+    def delete_dashboards(self, DashboardNames: list):
+        self._call("DeleteDashboards")
+        with self.lock:
+            missing = [name for name in DashboardNames if name not in self.dashboards]
+            if missing:
+                raise client_error("ResourceNotFound",
+                                   "Dashboards {0} do not exist".format(missing),
+                                   "DeleteDashboards")
+            for name in DashboardNames:
+                del self.dashboards[name]
+        return {}
@@ -0,0 +1,125 @@
+import time
+import uuid
+import threading
+import collections
+from botocore.exceptions import ClientError
+
+"""
+SQS キュー API のローカルエミュレータ
+
+send_message / receive_message / delete_message_batch を
+メモリ上で再現する。キュードレイナーの動作確認で boto3 クライアントの代わりに使う。
+"""
+
+
+MAX_RECEIVE_MESSAGES = 10
+MAX_BATCH_ENTRIES = 10
+DEFAULT_VISIBILITY_TIMEOUT = 30
+
+def client_error(code: str, message: str, operation: str):
+    """create ClientError same as boto3 raises
+
+    Args:
+        code (str): error code
+        message (str): error message
+        operation (str): operation name
+
+    Returns:
+        ClientError: error object
+    """
+    return ClientError({"Error": {"Code": code, "Message": message},
+                        "ResponseMetadata": {"HTTPStatusCode": 400}},
+                       operation)
+
+class LocalSQS:
+    """in-memory sqs client which supports a standard queue
+
+    Messages received are invisible until VisibilityTimeout expires
+    and delivered again if they are not deleted.
+
+    Args:
+        latency (float, optional): seconds to sleep on every API call
+        visibility_timeout (int, optional): default VisibilityTimeout of the queue
+    """
+
+    def __init__(self, latency: float=0.0, visibility_timeout: int=DEFAULT_VISIBILITY_TIMEOUT):
+        self.latency = latency
+        self.visibility_timeout = visibility_timeout
+        # {MessageId: {"Body": ..., "ReceiptHandle": ..., "VisibleAt": ..., "ReceiveCount": ...}}
+        self.messages = collections.OrderedDict()
+        self.calls = collections.Counter()
+        self.cond = threading.Condition()
+
+    def _call(self, operation: str):
+        with self.cond:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def send_message(self, QueueUrl: str, MessageBody: str):
+        self._call("SendMessage")
+        msgid = str(uuid.uuid4())
+        with self.cond:
+            self.messages[msgid] = {"Body": MessageBody, "ReceiptHandle": None,
+                                    "VisibleAt": 0.0, "ReceiveCount": 0}
+            self.cond.notify_all()
+        return {"MessageId": msgid}
+
+    def _visible(self, now: float, count: int):
+        msgids = list()
+        for msgid, message in self.messages.items():
+            if message["VisibleAt"] <= now:
+                msgids.append(msgid)
+                if len(msgids) == count:
+                    break
+        return msgids
+
+    def receive_message(self, QueueUrl: str, MaxNumberOfMessages: int=1,
+                        WaitTimeSeconds: int=0, VisibilityTimeout: int=None):
+        self._call("ReceiveMessage")
+        if not 1 <= MaxNumberOfMessages <= MAX_RECEIVE_MESSAGES:
+            raise client_error("InvalidParameterValue",
+                               "MaxNumberOfMessages must be 1 to {0}".format(MAX_RECEIVE_MESSAGES),
+                               "ReceiveMessage")
+        if VisibilityTimeout is None:
+            VisibilityTimeout = self.visibility_timeout
+        deadline = time.time() + WaitTimeSeconds
+        with self.cond:
+            msgids = self._visible(time.time(), MaxNumberOfMessages)
+            while not msgids and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+                msgids = self._visible(time.time(), MaxNumberOfMessages)
+            received = list()
+            for msgid in msgids:
+                message = self.messages[msgid]
+                message["ReceiptHandle"] = str(uuid.uuid4())
+                message["VisibleAt"] = time.time() + VisibilityTimeout
+                message["ReceiveCount"] += 1
+                received.append({"MessageId": msgid,
+                                 "ReceiptHandle": message["ReceiptHandle"],
+                                 "Body": message["Body"]})
+        res = {"ResponseMetadata": {"HTTPStatusCode": 200}}
+        if received:
+            res["Messages"] = received
+        return res
+
+    def delete_message_batch(self, QueueUrl: str, Entries: list):
+        self._call("DeleteMessageBatch")
+        if not 1 <= len(Entries) <= MAX_BATCH_ENTRIES:
+            raise client_error("TooManyEntriesInBatchRequest",
+                               "Maximum number of entries per request are {0}".format(MAX_BATCH_ENTRIES),
+                               "DeleteMessageBatch")
+        successful = list()
+        failed = list()
+        with self.cond:
+            handles = {message["ReceiptHandle"]: msgid for msgid, message in self.messages.items()}
+            for entry in Entries:
+                msgid = handles.get(entry["ReceiptHandle"])
+                if msgid is None:
+                    failed.append({"Id": entry["Id"], "SenderFault": True,
+                                   "Code": "ReceiptHandleIsInvalid",
+                                   "Message": "The receipt handle is not valid"})
+                    continue
+                del self.messages[msgid]
+                successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": failed}
@@ -0,0 +1,584 @@
+import os
+import json
+import time
+import logging
+import argparse
+import aws_clients
+import registrar_metrics
+import write_scheduler
+from concurrent.futures import ThreadPoolExecutor
+from dashboard_model import (WIDGET_MODE, WIDGET_MODE_SEARCH, SEARCH_SCOPE, SEARCH_SCOPE_ALL,
+                             init_dbinfos, gen_dbname, shard_pattern, widget_summary,
+                             new_dashboard, registered_volumes, dashboard_volumes,
+                             dashboard_locations, is_limit_dashboard, pack_volumes, plan_volume,
+                             add_volume_to_dashboard, remove_volumes_from_dashboard, dump_dashboard)
+from dashboard_io import (init_cwclient, list_shards, parse_dashboard, get_dashboard_body,
+                          write_dashboard_body, write_dashboards, body_digest, PUT_VERIFY_DELAY,
+                          put_deadline, HOME_TARGET, target_prefix, target_client, init_dedupe_store,
+                          route_key, route_pattern, group_routes, shard_prefixes)
+
+"""
+CloudWatch ダッシュボードを既存のボリューム一覧と突き合わせて再構築する
+
+ダッシュボード未登録のボリュームを追加し、削除済みのボリュームを取り除く。
+compact モードではまばらになったウィジェットとダッシュボードを詰め直し、
+空になったダッシュボードを削除する。
+SHARD_ROUTING でシャードグループに振り分けている場合は全グループを突き合わせ,
+未登録のボリュームをそのグループに追加する。詰め直しはグループごとに行う。
+複数リージョンを指定した場合はリージョンごとに並列で実行する。
+SQS のハンドラと同時に実行しても変更が失われないように, 突き合わせの結果は
+compare-and-swap で書き込み, 詰め直しは読み込み後に他から更新されていれば中止する。
+Lambda から定期実行するか、ボリューム一覧のファイルを指定してローカルで実行する。
+"""
+
+
+RECONCILE_WORKERS = int(os.getenv('RECONCILE_WORKERS', '8'))
+RECONCILE_REGION_WORKERS = int(os.getenv('RECONCILE_REGION_WORKERS', '4'))
+VOLUME_STATES = ("creating", "available", "in-use")
+MAX_DELETE_DASHBOARDS = 100
+
+# reused across warm invocations
+ec2clients = dict()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def init_ec2client(region: str=None):
+    """initialize boto3 ec2 client
+
+    Client is created once per region and reused across warm invocations.
+
+    Args:
+        region (str, optional): region name. Defaults to lambda region.
+
+    Returns:
+        boto3.client: ec2 client object
+    """
+    if region not in ec2clients:
+        ec2clients[region] = aws_clients.create_client("ec2", region)
+    return ec2clients[region]
+
+def volume_ids(obj):
+    """extract VolumeIds from describe_volumes output
+
+    Args:
+        obj: describe_volumes page {"Volumes": [...]}, volume dict,
+            VolumeId string or list of them
+
+    Yields:
+        str: VolumeId
+    """
+    if isinstance(obj, str):
+        yield obj
+    elif isinstance(obj, list):
+        for item in obj:
+            yield from volume_ids(item)
+    elif "Volumes" in obj:
+        yield from volume_ids(obj["Volumes"])
+    elif obj.get("State", "available") in VOLUME_STATES:
+        yield obj["VolumeId"]
+
+def volume_tags(obj):
+    """extract tags of volumes from describe_volumes output
+
+    Args:
+        obj: describe_volumes page, volume dict, VolumeId string or list of them
+
+    Yields:
+        tuple: (VolumeId, {tag key: tag value}) of volumes having tags
+    """
+    if isinstance(obj, list):
+        for item in obj:
+            yield from volume_tags(item)
+    elif isinstance(obj, dict) and "Volumes" in obj:
+        yield from volume_tags(obj["Volumes"])
+    elif isinstance(obj, dict) and obj.get("Tags"):
+        yield obj["VolumeId"], {tag["Key"]: tag["Value"] for tag in obj["Tags"]}
+
+def load_volumes(path: str):
+    """load describe_volumes output from JSON or JSONL file
+
+    Args:
+        path (str): file path. JSONL is assumed if it ends with ".jsonl"
+
+    Returns:
+        list: pages, volume dicts or VolumeIds. see volume_ids()
+    """
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+def describe_volumes(region: str=None, client=None):
+    """get all volumes with describe_volumes
+
+    Args:
+        region (str, optional): region name. Defaults to lambda region.
+        client (boto3.client, optional): ec2 client. Defaults to init_ec2client(region).
+
+    Returns:
+        list: volume dicts
+    """
+    if client is None:
+        client = init_ec2client(region)
+    paginator = client.get_paginator("describe_volumes")
+    volumes = list()
+    for page in paginator.paginate(PaginationConfig={"PageSize": 500}):
+        volumes.extend(page["Volumes"])
+    return volumes
+
+def load_shards(client, dbname_prefix: str, max_workers: int=RECONCILE_WORKERS,
+                target: tuple=HOME_TARGET):
+    """get all dashboard models having the prefix
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        max_workers (int, optional): number of parallel get_dashboard
+        target (tuple, optional): (region, account) of volumes
+
+    Returns:
+        list: dashboard models ordered by numeric suffix
+    """
+    names = [entry['DashboardName'] for entry in list_shards(client, dbname_prefix)]
+    # parsed right after get_dashboard to keep read_at of the model close to the read
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda name: parse_dashboard(name, get_dashboard_body(client, name), target),
+                             names))
+
+def plan_reconcile(dashboards: list, dbname_prefix: str, volids: list,
+                   target: tuple=HOME_TARGET, tags: dict=None):
+    """compute dashboard models which must be written
+
+    Deleted volumes are removed from its dashboard and
+    unregistered volumes are placed to dashboards of its shard group having free space.
+
+    Args:
+        dashboards (list): dashboard models of all shard groups ordered by numeric suffix
+        dbname_prefix (str): dashboard name prefix
+        volids (list): VolumeIds of all volumes
+        target (tuple, optional): (region, account) of volumes
+        tags (dict, optional): {VolumeId: tags} used by tag routing
+
+    Returns:
+        tuple: ({dashboard name: dashboard model}, [VolumeId added], [VolumeId removed])
+    """
+    inventory = set(volids)
+    touched = dict()
+    current = set()
+    removed = list()
+    for dashboard in dashboards:
+        reged = registered_volumes(dashboard)
+        current |= reged
+        stale = reged - inventory
+        if stale:
+            removed.extend(remove_volumes_from_dashboard(dashboard, stale))
+            touched[dashboard["name"]] = dashboard
+    added = [volid for volid in dict.fromkeys(volids) if volid not in current]
+    tags = tags or dict()
+    routes = group_routes(dbname_prefix, {volid: route_key(volid, tags.get(volid)) for volid in added})
+    for prefix, route_volids in routes.items():
+        pattern = shard_pattern(prefix)
+        shards = [dashboard for dashboard in dashboards if pattern.match(dashboard["name"])]
+        if not shards:
+            shards = [new_dashboard(next(gen_dbname(prefix)), target)]
+        packed, _ = pack_volumes(shards, route_volids,
+                                 lambda name: new_dashboard(init_dbinfos(name), target))
+        for dashboard in packed:
+            # SEARCH expressions of all volumes are not changed by new volumes
+            if dashboard["pending"]:
+                touched[dashboard["name"]] = dashboard
+    return touched, added, removed
+
+def plan_compact(dashboards: list):
+    """repack volumes into the fewest dashboards and widgets
+
+    Volumes are packed in registered order from the first dashboard.
+    Widgets not managed by this script stay in its dashboard.
+
+    Args:
+        dashboards (list): dashboard models ordered by numeric suffix
+
+    Returns:
+        tuple: ([dashboard model changed], [dashboard name emptied])
+    """
+    if WIDGET_MODE == WIDGET_MODE_SEARCH and SEARCH_SCOPE == SEARCH_SCOPE_ALL:
+        # SEARCH expressions match all volumes and have nothing to repack
+        return [], []
+    volids = list()
+    packed = list()
+    for dashboard in dashboards:
+        volids.extend(dashboard_volumes(dashboard))
+        repacked = new_dashboard(dashboard["name"], dashboard["target"])
+        repacked["widgets"] = dashboard["widgets"]
+        repacked["totalmetrics"] = sum([widget_summary(widget)[1]
+                                        for widget in dashboard["widgets"]])
+        # widgets not managed by this script use bytes of the dashboard
+        repacked["size"] = len(dump_dashboard(repacked).encode("utf-8"))
+        packed.append(repacked)
+    i = 0
+    for volid in dict.fromkeys(volids):
+        plan = plan_volume(packed[i], volid)
+        while is_limit_dashboard(packed[i], plan):
+            i += 1
+            if i == len(packed):
+                packed.append(new_dashboard(init_dbinfos(packed[-1]["name"]), packed[-1]["target"]))
+            plan = plan_volume(packed[i], volid)
+        add_volume_to_dashboard(packed[i], volid, plan)
+    digests = {dashboard["name"]: dashboard["digest"] for dashboard in dashboards}
+    changed = list()
+    emptied = list()
+    for repacked in packed:
+        if not repacked["widgets"] and not repacked["pending"]:
+            if digests.get(repacked["name"]) is not None:
+                emptied.append(repacked["name"])
+        elif body_digest(dump_dashboard(repacked)) != digests.get(repacked["name"]):
+            changed.append(repacked)
+    return changed, emptied
+
+def delete_dashboards(client, dbnames: list):
+    """delete dashboards
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbnames (list): dashboard names
+
+    Returns:
+        list: dashboard names failed to delete
+    """
+    failed = list()
+    for i in range(0, len(dbnames), MAX_DELETE_DASHBOARDS):
+        chunk = dbnames[i:i + MAX_DELETE_DASHBOARDS]
+        try:
+            client.delete_dashboards(DashboardNames=chunk)
+        except (aws_clients.BotoCoreError,
+                aws_clients.ClientError) as e:
+            logger.error("Failed to delete dashboards {0}: {1}".format(chunk, e))
+            failed.extend(chunk)
+    return failed
+
+def put_dashboards(client, dashboards: list, max_workers: int=RECONCILE_WORKERS):
+    """put dashboards in parallel with compare-and-swap
+
+    Changes of SQS handlers running at once are merged. see write_dashboards()
+    Elements of dashboards are replaced with the dashboard models written.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dashboards (list): dashboard models
+        max_workers (int, optional): number of parallel put_dashboard
+
+    Returns:
+        tuple: ([dashboard name failed to put], [VolumeId which does not fit in dashboard])
+    """
+    # each worker verifies its puts once after PUT_VERIFY_DELAY
+    chunks = [list(range(i, len(dashboards), max_workers))
+              for i in range(min(max_workers, len(dashboards)))]
+
+    def put(chunk):
+        written = [dashboards[i] for i in chunk]
+        failed, overflow = write_dashboards(client, written)
+        for i, dashboard in zip(chunk, written):
+            dashboards[i] = dashboard
+        return failed, overflow
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(put, chunks))
+    return ([name for failed, _ in results for name in failed],
+            [volid for _, overflow in results for volid in overflow])
+
+def swap_dashboards(client, dashboards: list, digests: dict, emptied: list=(),
+                    max_workers: int=RECONCILE_WORKERS):
+    """put repacked dashboards only if no writer changed them after they were loaded
+
+    Repacked dashboards can not be merged with changes of other writers,
+    so nothing is put if a digest is changed, and the puts are reported as failed
+    if they are overwritten until PUT_VERIFY_DELAY. Each digest is checked again
+    right before its put, and the put is not sent if it is delayed beyond put_deadline().
+    Changes lost by the failure are restored by next reconcile.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dashboards (list): dashboard models
+        digests (dict): {dashboard name: digest when loaded}
+        emptied (list, optional): dashboard names which will be deleted
+        max_workers (int, optional): number of parallel API calls
+
+    Returns:
+        list: dashboard names failed to put. emptied dashboards are included if aborted.
+    """
+    names = [dashboard["name"] for dashboard in dashboards]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        current = list(pool.map(lambda name: body_digest(get_dashboard_body(client, name)),
+                                names + list(emptied)))
+    conflicts = [name for name, digest in zip(names + list(emptied), current) if digest != digests.get(name)]
+    if conflicts:
+        logger.error("Dashboards {0} were updated by other writer, compaction is aborted".format(conflicts))
+        return names + list(emptied)
+    if not dashboards:
+        return []
+
+    def put(dashboard):
+        dbody = dump_dashboard(dashboard)
+        try:
+            # checked again right before the put, see dashboard_io.put_deadline()
+            acquired = write_scheduler.acquire(client, "put_dashboard")
+            if body_digest(get_dashboard_body(client, dashboard["name"])) != digests.get(dashboard["name"]):
+                logger.error("Dashboard {0} was updated by other writer".format(dashboard["name"]))
+                return None
+            write_dashboard_body(client, dashboard["name"], dbody, put_deadline(time.monotonic()),
+                                 acquired)
+        except (aws_clients.BotoCoreError,
+                aws_clients.ClientError,
+                write_scheduler.DeadlineExceeded) as e:
+            logger.error("Failed to put dashboard {0}: {1}".format(dashboard["name"], e))
+            return None
+        return dbody
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        bodies = list(pool.map(put, dashboards))
+    # wait for writers which read before these puts to finish their put
+    time.sleep(PUT_VERIFY_DELAY)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        written = list(pool.map(lambda name: get_dashboard_body(client, name), names))
+    failed = list()
+    for name, dbody, current in zip(names, bodies, written):
+        if dbody is None or current != dbody:
+            if dbody is not None:
+                logger.error("Dashboard {0} was overwritten by other writer".format(name))
+            failed.append(name)
+    return failed
+
+def rebuild_index(dbname_prefix: str, dashboards: list):
+    """rebuild reverse index of the prefix from dashboard models of all shards
+
+    Args:
+        dbname_prefix (str): dashboard name prefix
+        dashboards (list): dashboard models of all shards.
+            dashboards of other prefixes are ignored.
+    """
+    pattern = shard_pattern(dbname_prefix)
+    locations = dict()
+    for dashboard in dashboards:
+        if pattern.match(dashboard["name"]):
+            locations.update(dashboard_locations(dashboard))
+    init_dedupe_store().rebuild(dbname_prefix, locations)
+
+def reconcile(client, dbname_prefix: str, volids: list,
+              max_workers: int=RECONCILE_WORKERS, dry_run: bool=False,
+              target: tuple=HOME_TARGET, tags: dict=None):
+    """rebuild dashboards having the prefix and its shard groups from all volumes
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        volids (list): VolumeIds of all volumes
+        max_workers (int, optional): number of parallel API calls
+        dry_run (bool, optional): do not put dashboards if True
+        target (tuple, optional): (region, account) of volumes
+        tags (dict, optional): {VolumeId: tags} used by tag routing
+
+    Returns:
+        dict: summary of reconcile
+    """
+    prefixes = shard_prefixes(client, dbname_prefix, refresh=True)
+    dashboards = list()
+    for prefix in prefixes:
+        dashboards.extend(load_shards(client, prefix, max_workers, target))
+    touched, added, removed = plan_reconcile(dashboards, dbname_prefix, volids, target, tags)
+    logger.info("Reconcile {0}: add {1} volumes, remove {2} volumes, put {3} dashboards".format(
+        dbname_prefix, len(added), len(removed), len(touched)))
+    failed = list()
+    if not dry_run:
+        written = list(touched.values())
+        failed, overflow = put_dashboards(client, written, max_workers)
+        for volid in overflow:
+            logger.warning("{0} is not registered, dashboard is full".format(volid))
+        added = [volid for volid in added if volid not in overflow]
+        touched = {dashboard["name"]: dashboard for dashboard in written}
+        if not failed:
+            shards = {dashboard["name"]: dashboard for dashboard in dashboards}
+            shards.update(touched)
+            # shard groups created by this reconcile
+            pattern = route_pattern(dbname_prefix)
+            for name in touched:
+                match = pattern.match(name)
+                if match and match.group(1) not in prefixes:
+                    prefixes.append(match.group(1))
+            for prefix in prefixes:
+                rebuild_index(prefix, shards.values())
+    return {"added": added,
+            "removed": removed,
+            "dashboards": list(touched.keys()),
+            "failed": failed}
+
+def compact(client, dbname_prefix: str,
+            max_workers: int=RECONCILE_WORKERS, dry_run: bool=False,
+            target: tuple=HOME_TARGET):
+    """repack dashboards having the prefix and delete emptied dashboards
+
+    Each shard group is repacked separately not to move volumes between groups.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        max_workers (int, optional): number of parallel API calls
+        dry_run (bool, optional): do not put or delete dashboards if True
+        target (tuple, optional): (region, account) of volumes
+
+    Returns:
+        dict: summary of compaction
+    """
+    result = {"dashboards": [], "deleted": [], "failed": []}
+    for prefix in shard_prefixes(client, dbname_prefix, refresh=True):
+        compacted = compact_shards(client, prefix, max_workers, dry_run, target)
+        for key, value in result.items():
+            value.extend(compacted[key])
+    return result
+
+def compact_shards(client, dbname_prefix: str,
+                   max_workers: int=RECONCILE_WORKERS, dry_run: bool=False,
+                   target: tuple=HOME_TARGET):
+    """repack shards of a prefix and delete emptied dashboards
+
+    Args:
+        client (boto3.client): cloudwatch client
+        dbname_prefix (str): dashboard name prefix
+        max_workers (int, optional): number of parallel API calls
+        dry_run (bool, optional): do not put or delete dashboards if True
+        target (tuple, optional): (region, account) of volumes
+
+    Returns:
+        dict: summary of compaction
+    """
+    dashboards = load_shards(client, dbname_prefix, max_workers, target)
+    changed, emptied = plan_compact(dashboards)
+    logger.info("Compact {0}: put {1} dashboards, delete {2} dashboards".format(
+        dbname_prefix, len(changed), len(emptied)))
+    failed = list()
+    if not dry_run:
+        failed = swap_dashboards(client, changed, {dashboard["name"]: dashboard["digest"]
+                                                   for dashboard in dashboards},
+                                 emptied, max_workers)
+        # keep emptied dashboards if repacked dashboards were not written
+        if not failed:
+            failed = delete_dashboards(client, emptied)
+        if not failed:
+            shards = {dashboard["name"]: dashboard for dashboard in dashboards}
+            shards.update({dashboard["name"]: dashboard for dashboard in changed})
+            rebuild_index(dbname_prefix, [dashboard for name, dashboard in shards.items()
+                                          if name not in emptied])
+    return {"dashboards": [dashboard["name"] for dashboard in changed],
+            "deleted": emptied,
+            "failed": failed}
+
+def reconcile_regions(dbname_prefix: str, regions: list, compaction: bool=False,
+                      max_workers: int=RECONCILE_WORKERS,
+                      region_workers: int=RECONCILE_REGION_WORKERS, dry_run: bool=False):
+    """reconcile or compact dashboards of regions concurrently
+
+    Clients are created before the regions are processed
+    because boto3 does not create clients safely in threads.
+
+    Args:
+        dbname_prefix (str): dashboard name prefix of home region
+        regions (list): region names
+        compaction (bool, optional): compact dashboards instead of reconcile
+        max_workers (int, optional): number of parallel API calls per region
+        region_workers (int, optional): number of regions processed in parallel
+        dry_run (bool, optional): do not put or delete dashboards if True
+
+    Returns:
+        dict: {region name: summary of reconcile or compaction}
+    """
+    jobs = list()
+    for region in regions:
+        target = (region, None)
+        jobs.append((region, target, target_client(init_cwclient(), target),
+                     None if compaction else init_ec2client(region)))
+
+    def run(job):
+        region, target, client, ec2client = job
+        prefix = target_prefix(dbname_prefix, target)
+        try:
+            if compaction:
+                return compact(client, prefix, max_workers, dry_run, target)
+            volumes = describe_volumes(region, ec2client)
+            return reconcile(client, prefix, list(volume_ids(volumes)),
+                             max_workers, dry_run, target, dict(volume_tags(volumes)))
+        except (aws_clients.BotoCoreError,
+                aws_clients.ClientError) as e:
+            logger.error("Failed to reconcile {0}: {1}".format(prefix, e))
+            return {"dashboards": [], "failed": [prefix]}
+
+    with ThreadPoolExecutor(max_workers=region_workers) as pool:
+        return dict(zip(regions, pool.map(run, jobs)))
+
+def lambda_handler(event, context):
+    registrar_metrics.reset()
+    dbname_prefix = event.get('prefix', os.getenv('DBOARD_PREFIX'))
+    if event.get('regions'):
+        results = reconcile_regions(dbname_prefix, event['regions'],
+                                    compaction=event.get('mode') == "compact",
+                                    dry_run=event.get('dry_run', False))
+        registrar_metrics.emit({"DashboardPrefix": str(dbname_prefix)})
+        failed = [name for result in results.values() for name in result["failed"]]
+        return {"result": results,
+                "responsecode": 200 if not failed else -1}
+    if event.get('mode') == "compact":
+        result = compact(init_cwclient(), dbname_prefix,
+                         dry_run=event.get('dry_run', False))
+    else:
+        volumes = describe_volumes()
+        result = reconcile(init_cwclient(), dbname_prefix, list(volume_ids(volumes)),
+                           dry_run=event.get('dry_run', False), tags=dict(volume_tags(volumes)))
+    registrar_metrics.emit({"DashboardPrefix": str(dbname_prefix)})
+    return {"result": result,
+            "responsecode": 200 if not result["failed"] else -1}
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile EBS metrics dashboards with volumes")
+    parser.add_argument("--prefix", default=os.getenv('DBOARD_PREFIX'),
+                        help="dashboard name prefix")
+    parser.add_argument("--inventory",
+                        help="JSON/JSONL file of describe_volumes output. "
+                             "describe_volumes is called if omitted")
+    parser.add_argument("--region", help="region name")
+    parser.add_argument("--regions",
+                        help="comma separated region names processed in parallel. "
+                             "volumes are described in each region")
+    parser.add_argument("--workers", type=int, default=RECONCILE_WORKERS,
+                        help="number of parallel API calls")
+    parser.add_argument("--compact", action="store_true",
+                        help="repack dashboards and delete emptied dashboards")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="do not put dashboards")
+    args = parser.parse_args()
+    if args.regions:
+        results = reconcile_regions(args.prefix, args.regions.split(","), args.compact,
+                                    max_workers=args.workers, dry_run=args.dry_run)
+        print(json.dumps({region: {key: len(value) if key in ("added", "removed") else value
+                                   for key, value in result.items()}
+                          for region, result in results.items()}))
+        return
+    # widgets show metrics of the region dashboards are written in
+    target = (args.region, None) if args.region else HOME_TARGET
+    if args.compact:
+        result = compact(init_cwclient(args.region), args.prefix,
+                         max_workers=args.workers, dry_run=args.dry_run, target=target)
+        print(json.dumps(result))
+        return
+    if args.inventory:
+        volumes = load_volumes(args.inventory)
+    else:
+        volumes = describe_volumes(args.region)
+    result = reconcile(init_cwclient(args.region), args.prefix, list(volume_ids(volumes)),
+                       max_workers=args.workers, dry_run=args.dry_run, target=target,
+                       tags=dict(volume_tags(volumes)))
+    print(json.dumps({"added": len(result["added"]),
+                      "removed": len(result["removed"]),
+                      "dashboards": result["dashboards"],
+                      "failed": result["failed"]}))
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    main()
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+"""
+ボリューム登録処理自身のメトリクスを集計する
+
+API 呼び出し時間, DashboardBody のサイズ, 走査したウィジェット数などを
+呼び出しごとに集計し, CloudWatch Embedded Metric Format で標準出力に書き出す。
+"""
+
+
+EMF_NAMESPACE = os.getenv('EMF_NAMESPACE', 'EBSMetricsRegistrar')
+UNIT_MILLISECONDS = "Milliseconds"
+UNIT_BYTES = "Bytes"
+UNIT_COUNT = "Count"
+UNIT_PERCENT = "Percent"
+
+# {metric name: [value, unit]} of current invocation
+stats = dict()
+lock = threading.Lock()
+
+def reset():
+    """clear metrics of previous invocation"""
+    with lock:
+        stats.clear()
+
+def count(name: str, value: float=1, unit: str=UNIT_COUNT):
+    """add value to metric
+
+    Args:
+        name (str): metric name
+        value (float, optional): value added. Defaults to 1.
+        unit (str, optional): unit of metric. Defaults to UNIT_COUNT.
+    """
+    with lock:
+        if name in stats:
+            stats[name][0] += value
+        else:
+            stats[name] = [value, unit]
+
+def gauge(name: str, value: float, unit: str=UNIT_COUNT):
+    """keep maximum value of metric
+
+    Args:
+        name (str): metric name
+        value (float): value
+        unit (str, optional): unit of metric. Defaults to UNIT_COUNT.
+    """
+    with lock:
+        if name not in stats or stats[name][0] < value:
+            stats[name] = [value, unit]
+
+@contextlib.contextmanager
+def timer(name: str):
+    """add elapsed milliseconds of the block to metric
+
+    Args:
+        name (str): metric name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(name, (time.perf_counter() - start) * 1000, UNIT_MILLISECONDS)
+
+def emit(dimensions: dict):
+    """write metrics of current invocation as Embedded Metric Format
+
+    Args:
+        dimensions (dict): dimension name and value
+
+    Returns:
+        dict: EMF document written
+    """
+    with lock:
+        values = {name: round(value, 3) for name, (value, _) in stats.items()}
+        definitions = [{"Name": name, "Unit": unit} for name, (_, unit) in stats.items()]
+    doc = {"_aws": {"Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [{"Namespace": EMF_NAMESPACE,
+                                           "Dimensions": [list(dimensions.keys())],
+                                           "Metrics": definitions}]}}
+    doc.update(dimensions)
+    doc.update(values)
+    print(json.dumps(doc))
+    return doc
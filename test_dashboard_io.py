@@ -0,0 +1,182 @@
+import os
+import json
+import unittest
+import contextlib
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import dashboard_model
+import dashboard_io
+import registrar_metrics
+from local_cloudwatch import LocalCloudWatch
+from bench_cwmetrics import synthetic_events, handler_instance, volume_counts
+
+"""
+ダッシュボードの compare-and-swap 書き込みのテスト
+
+別々のキャッシュを持つ SQS ハンドラを LocalCloudWatch 上で交互に動かし,
+他の書き込みとの衝突時のマージ, 検証, 入りきらないボリュームの
+batchItemFailures での報告と, ボリュームが欠落や重複なく登録されることを確認する。
+"""
+
+
+DBOARD_NAME = "test"
+SHARD_NAME = "{0} 1".format(DBOARD_NAME)
+
+class InterleavedCloudWatch(LocalCloudWatch):
+    """LocalCloudWatch which runs other writer at a given call of a dashboard"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # {(operation, dashboard name): [calls left, function]}
+        self.hooks = dict()
+
+    def interleave(self, operation: str, dbname: str, calls: int, function):
+        """run function before the calls-th get or after the calls-th put of dashboard
+
+        Args:
+            operation (str): "get_dashboard" or "put_dashboard"
+            dbname (str): dashboard name
+            calls (int): number of calls from now
+            function (callable): other writer
+        """
+        self.hooks[(operation, dbname)] = [calls, function]
+
+    def _hook(self, operation: str, dbname: str):
+        hook = self.hooks.get((operation, dbname))
+        if hook is None:
+            return
+        hook[0] -= 1
+        if hook[0] == 0:
+            del self.hooks[(operation, dbname)]
+            hook[1]()
+
+    def get_dashboard(self, DashboardName: str):
+        self._hook("get_dashboard", DashboardName)
+        return super().get_dashboard(DashboardName)
+
+    def put_dashboard(self, DashboardName: str, DashboardBody: str):
+        response = super().put_dashboard(DashboardName, DashboardBody)
+        self._hook("put_dashboard", DashboardName)
+        return response
+
+def invocation(volids: list):
+    """SQS event of CreateVolume events
+
+    Args:
+        volids (list): numbers of VolumeId
+
+    Returns:
+        dict: SQS event. messageId is VolumeId
+    """
+    records = list()
+    for volid in volids:
+        event = synthetic_events(1, volid)[0]
+        records.append({"messageId": event["resources"][0].split("/")[1],
+                        "body": json.dumps(event)})
+    return {"Records": records}
+
+def volume_id(number: int):
+    """VolumeId of synthetic_events()"""
+    return invocation([number])["Records"][0]["messageId"]
+
+class CasTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['DBOARD_PREFIX'] = DBOARD_NAME
+        self.stack = contextlib.ExitStack()
+        # read before every put to make interleaving deterministic
+        self.stack.enter_context(mock.patch.object(dashboard_io, "PUT_VERIFY_DELAY", 0))
+        # EMF lines of registrar_metrics
+        devnull = self.stack.enter_context(open(os.devnull, "w"))
+        self.stack.enter_context(contextlib.redirect_stdout(devnull))
+        registrar_metrics.reset()
+        self.client = InterleavedCloudWatch()
+
+    def tearDown(self):
+        self.stack.close()
+
+    def handlers(self, count: int):
+        """SQS handlers which have their own caches like Lambda containers"""
+        return [handler_instance(self.client, i) for i in range(count)]
+
+    def invoke(self, handler, volids: list):
+        response = handler.lambda_handler(invocation(volids), None)
+        return [failure["itemIdentifier"] for failure in response["batchItemFailures"]]
+
+    def assert_registered_once(self, volids: list):
+        counts = volume_counts(self.client)
+        for volid in map(volume_id, volids):
+            for key in dashboard_model.METRICS_TEMPLATE.keys():
+                self.assertEqual(counts[(volid, key)], 1, "{0} {1}".format(volid, key))
+        self.assertEqual({volid for volid, _ in counts}, set(map(volume_id, volids)))
+
+    def test_merge_after_digest_change(self):
+        """other writer puts between load and check, so the check merges it"""
+        first, second = self.handlers(2)
+        self.assertEqual(self.invoke(first, [0]), [])
+        self.assertEqual(self.invoke(second, [1]), [])
+        # 1st get loads the shard, 2nd get is the check before the put
+        self.client.interleave("get_dashboard", SHARD_NAME, 2,
+                               lambda: self.assertEqual(self.invoke(first, [2]), []))
+        self.assertEqual(self.invoke(second, [3]), [])
+        self.assertEqual(registrar_metrics.stats["Conflicts"][0], 1)
+        self.assertNotIn("Retries", registrar_metrics.stats)
+        self.assert_registered_once([0, 1, 2, 3])
+
+    def test_overwrite_before_verify(self):
+        """other writer checked before the put overwrites it, so verify fails and the put is merged again"""
+        first, second = self.handlers(2)
+        self.assertEqual(self.invoke(first, [0]), [])
+        self.assertEqual(self.invoke(second, [1]), [])
+        stale = dashboard_io.parse_dashboard(SHARD_NAME, self.client.dashboards[SHARD_NAME]["DashboardBody"])
+        dashboard_model.add_volume_to_dashboard(stale, volume_id(2))
+        self.client.interleave("put_dashboard", SHARD_NAME, 1,
+                               lambda: self.client.put_dashboard(SHARD_NAME, dashboard_model.dump_dashboard(stale)))
+        self.assertEqual(self.invoke(second, [3]), [])
+        self.assertEqual(registrar_metrics.stats["Retries"][0], 1)
+        self.assert_registered_once([0, 1, 2, 3])
+
+    def test_overflow_reported(self):
+        """volume which does not fit after merge is a batch item failure and retried"""
+        rows = dashboard_model.VOLUME_ROWS * 2
+        # dashboard_io of handlers imports the patched limit
+        with mock.patch.object(dashboard_model, "MAX_METRICS_DBOARD", rows):
+            first, second = self.handlers(2)
+            self.assertEqual(self.invoke(first, [0]), [])
+            # other writer fills the shard planned by second
+            self.client.interleave("get_dashboard", SHARD_NAME, 2,
+                                   lambda: self.assertEqual(self.invoke(first, [1]), []))
+            self.assertEqual(self.invoke(second, [2]), [volume_id(2)])
+            self.assertEqual(len(volume_counts(self.client)),
+                             len(dashboard_model.METRICS_TEMPLATE) * 2)
+            # redelivered message is registered to the next shard
+            self.assertEqual(self.invoke(second, [2]), [])
+        self.assertEqual(len(self.client.dashboards), 2)
+        self.assert_registered_once([0, 1, 2])
+
+    def test_concurrent_writers(self):
+        """writers running at once lose and duplicate no volume"""
+        volids = list(range(40))
+        with mock.patch.object(dashboard_io, "PUT_VERIFY_DELAY", 0.02):
+            handlers = self.handlers(4)
+
+        def invoke(i):
+            failures = list()
+            # each message is delivered twice
+            for volid in volids[i::len(handlers)] * 2:
+                failures.extend(self.invoke(handlers[i], [volid]))
+            # failed messages are redelivered until they succeed
+            for _ in range(dashboard_io.MAX_PUT_RETRIES):
+                if not failures:
+                    break
+                failures = [failed for failed in failures
+                            if self.invoke(handlers[i], [int(failed.split("-")[1], 16)])]
+            return failures
+
+        with ThreadPoolExecutor(max_workers=len(handlers)) as pool:
+            failures = sum(pool.map(invoke, range(len(handlers))), [])
+        self.assertEqual(failures, [])
+        self.assert_registered_once(volids)
+
+if __name__ == "__main__":
+    unittest.main()
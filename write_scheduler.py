@@ -0,0 +1,351 @@
+import os
+import time
+import random
+import threading
+import collections
+import aws_clients
+import registrar_metrics
+
+"""
+CloudWatch API の呼び出しをレート制限するスケジューラ
+
+API ごとのトークンバケットで呼び出しを API の上限以下に抑え、
+スロットリングされた場合はレートを下げてバックオフしてから再試行する。
+5xx やタイムアウトなど一時的なエラーもレートを下げずに再試行する。
+同じダッシュボードへの書き込みが待機中に重なった場合は最後の本文だけを書き込む。
+期限を指定した書き込みは, 待機と再試行で期限を過ぎると書き込まずに DeadlineExceeded を送出する。
+"""
+
+
+# calls per second and burst of each API. 0 disables the scheduler
+SCHEDULER_RATE = float(os.getenv('SCHEDULER_RATE', '10'))
+SCHEDULER_BURST = float(os.getenv('SCHEDULER_BURST', '10'))
+THROTTLE_RETRIES = int(os.getenv('THROTTLE_RETRIES', '5'))
+THROTTLE_BACKOFF_BASE = float(os.getenv('THROTTLE_BACKOFF_BASE', '0.2'))
+# rate is multiplied on throttling and increased by the ratio of max rate on success
+DECREASE_FACTOR = 0.5
+INCREASE_RATIO = 0.05
+MIN_RATE = 0.5
+THROTTLING_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded",
+                    "TooManyRequestsException")
+# errors retried without decreasing rate. 5xx status codes are retried too
+TRANSIENT_CODES = ("InternalFailure", "InternalError", "InternalServiceError",
+                   "ServiceUnavailable", "RequestTimeout", "RequestTimeoutException")
+# throttled and transient errors are retried by the scheduler, not inside botocore
+SCHEDULED_RETRIES = {"mode": "standard", "max_attempts": 1}
+
+class DeadlineExceeded(Exception):
+    """raised instead of calling API when the deadline passed while waiting"""
+
+def is_throttling(error: Exception):
+    """checks error whether it is throttling of AWS API
+
+    Args:
+        error (Exception): error raised by client
+
+    Returns:
+        bool: True if throttled
+    """
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code") in THROTTLING_CODES
+
+def is_transient(error: Exception):
+    """checks error whether the call may succeed if it is retried
+
+    Args:
+        error (Exception): error raised by client
+
+    Returns:
+        bool: True for 5xx, TRANSIENT_CODES, connection errors and timeouts
+    """
+    response = getattr(error, "response", None)
+    if response:
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return response.get("Error", {}).get("Code") in TRANSIENT_CODES or status >= 500
+    return isinstance(error, (aws_clients.ConnectionError, aws_clients.HTTPClientError))
+
+class TokenBucket:
+    """token bucket whose rate is decreased on throttling and recovered on success
+
+    Args:
+        rate (float): tokens per second
+        burst (float): capacity of tokens
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """take a token waiting until it is refilled
+
+        Returns:
+            tuple: (seconds waited, number of callers waiting including this)
+        """
+        start = time.monotonic()
+        with self.cond:
+            self.waiting += 1
+            depth = self.waiting
+            try:
+                self._refill()
+                while self.tokens < 1:
+                    self.cond.wait((1 - self.tokens) / self.rate)
+                    self._refill()
+                self.tokens -= 1
+            finally:
+                self.waiting -= 1
+        return time.monotonic() - start, depth
+
+    def throttled(self):
+        """decrease rate and drop tokens left after throttling"""
+        with self.cond:
+            self._refill()
+            self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        """increase rate toward max rate"""
+        with self.cond:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate * INCREASE_RATIO)
+
+class ScheduledClient:
+    """cloudwatch client whose dashboard APIs are called through token buckets
+
+    Throttled calls are retried with jittered backoff after the rate is decreased.
+    Transient errors are retried with the same backoff keeping the rate.
+    put_dashboard of a dashboard waiting for a token is coalesced with
+    later put_dashboard of the same dashboard.
+    Other attributes are passed to the client.
+
+    Args:
+        client (boto3.client): cloudwatch client
+        rate (float, optional): calls per second of each API
+        burst (float, optional): burst of each API
+        retries (int, optional): retries of throttled and transient errors
+    """
+
+    def __init__(self, client, rate: float=SCHEDULER_RATE, burst: float=SCHEDULER_BURST,
+                 retries: int=THROTTLE_RETRIES):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.buckets = dict()
+        # {dashboard name: put waiting for a token}
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.max_depth = 0
+        self.max_wait = 0.0
+
+    def __getattr__(self, name: str):
+        return getattr(self.client, name)
+
+    def bucket(self, operation: str):
+        """token bucket of the API
+
+        Args:
+            operation (str): method name of client
+
+        Returns:
+            TokenBucket: bucket
+        """
+        with self.lock:
+            if operation not in self.buckets:
+                self.buckets[operation] = TokenBucket(self.rate, self.burst)
+            return self.buckets[operation]
+
+    def _acquire(self, bucket: TokenBucket):
+        wait, depth = bucket.acquire()
+        with self.lock:
+            self.stats["waits"] += 1
+            self.stats["wait_seconds"] += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.max_depth = max(self.max_depth, depth)
+        registrar_metrics.count("SchedulerWaitTime", wait * 1000, registrar_metrics.UNIT_MILLISECONDS)
+        registrar_metrics.gauge("SchedulerQueueDepth", depth)
+
+    def call(self, operation: str, acquired: bool=False, deadline: float=None, **params):
+        """call API of client after taking a token
+
+        Args:
+            operation (str): method name of client
+            acquired (bool, optional): a token of the first attempt is already taken
+            deadline (float, optional): time.monotonic() which the API must be called before
+
+        Returns:
+            response of the API
+
+        Raises:
+            DeadlineExceeded: the deadline passed before the API was called
+        """
+        bucket = self.bucket(operation)
+        for attempt in range(self.retries + 1):
+            if attempt > 0 or not acquired:
+                self._acquire(bucket)
+            if deadline is not None and time.monotonic() > deadline:
+                raise DeadlineExceeded(operation)
+            try:
+                res = getattr(self.client, operation)(**params)
+            except Exception as e:
+                throttled = is_throttling(e)
+                if not (throttled or is_transient(e)) or attempt == self.retries:
+                    raise
+                if throttled:
+                    bucket.throttled()
+                    with self.lock:
+                        self.stats["throttled"] += 1
+                    registrar_metrics.count("Throttles")
+                else:
+                    with self.lock:
+                        self.stats["retried"] += 1
+                    registrar_metrics.count("TransientRetries")
+                backoff = random.uniform(0, THROTTLE_BACKOFF_BASE * (2 ** attempt))
+                if deadline is not None and time.monotonic() + backoff > deadline:
+                    raise DeadlineExceeded(operation)
+                time.sleep(backoff)
+                continue
+            bucket.succeeded()
+            return res
+
+    def get_dashboard(self, **params):
+        return self.call("get_dashboard", **params)
+
+    def list_dashboards(self, **params):
+        return self.call("list_dashboards", **params)
+
+    def delete_dashboards(self, **params):
+        return self.call("delete_dashboards", **params)
+
+    def put_dashboard(self, DashboardName: str, DashboardBody: str, deadline: float=None,
+                      acquired: bool=False):
+        """put dashboard coalescing puts of the same dashboard waiting for a token
+
+        Callers of coalesced puts get the result of the last body,
+        which is put before the deadline of the last body.
+
+        Args:
+            deadline (float, optional): time.monotonic() which the put must be sent before.
+                see call()
+            acquired (bool, optional): a token is already taken. see acquire()
+        """
+        with self.lock:
+            waiting = self.pending.get(DashboardName)
+            owner = waiting is None
+            if owner:
+                waiting = {"body": DashboardBody, "deadline": deadline, "done": threading.Event(),
+                           "result": None, "error": None}
+                self.pending[DashboardName] = waiting
+            else:
+                waiting["body"] = DashboardBody
+                waiting["deadline"] = deadline
+                self.stats["coalesced"] += 1
+        if not owner:
+            registrar_metrics.count("CoalescedWrites")
+            waiting["done"].wait()
+            if waiting["error"] is not None:
+                raise waiting["error"]
+            return waiting["result"]
+        if not acquired:
+            self._acquire(self.bucket("put_dashboard"))
+        # puts after this are not coalesced with the body being written
+        with self.lock:
+            del self.pending[DashboardName]
+            body = waiting["body"]
+            deadline = waiting["deadline"]
+        try:
+            waiting["result"] = self.call("put_dashboard", acquired=True, deadline=deadline,
+                                          DashboardName=DashboardName, DashboardBody=body)
+        except Exception as e:
+            waiting["error"] = e
+            raise
+        finally:
+            waiting["done"].set()
+        return waiting["result"]
+
+    def summary(self):
+        """statistics of the scheduler
+
+        Returns:
+            dict: calls waited, seconds waited, throttled, retried transient errors,
+                coalesced puts, max queue depth and current rates
+        """
+        with self.lock:
+            return {"waits": self.stats["waits"],
+                    "wait_seconds": round(self.stats["wait_seconds"], 3),
+                    "max_wait_seconds": round(self.max_wait, 3),
+                    "max_queue_depth": self.max_depth,
+                    "throttled": self.stats["throttled"],
+                    "retried": self.stats["retried"],
+                    "coalesced": self.stats["coalesced"],
+                    "rates": {operation: round(bucket.rate, 2)
+                              for operation, bucket in self.buckets.items()}}
+
+def create_client(service: str, region: str=None, rate: float=SCHEDULER_RATE):
+    """create client wrapped with scheduler unless it is disabled
+
+    Retries of botocore are disabled for the wrapped client
+    not to multiply calls retried by the scheduler. see ScheduledClient.call()
+
+    Args:
+        service (str): service name. e.g. "cloudwatch"
+        region (str, optional): region name. Defaults to lambda region.
+        rate (float, optional): calls per second of each API. 0 returns boto3 client as is
+
+    Returns:
+        ScheduledClient or boto3.client
+    """
+    if rate <= 0:
+        return aws_clients.create_client(service, region)
+    return ScheduledClient(aws_clients.create_client(service, region, SCHEDULED_RETRIES), rate)
+
+def acquire(client, operation: str):
+    """take a token of the API before the call which must follow a check quickly
+
+    Args:
+        client (ScheduledClient or boto3.client): client
+        operation (str): method name of client
+
+    Returns:
+        bool: True if a token is taken. pass it as acquired of put_dashboard()
+    """
+    if not isinstance(client, ScheduledClient):
+        return False
+    client._acquire(client.bucket(operation))
+    return True
+
+def put_dashboard(client, DashboardName: str, DashboardBody: str, deadline: float=None,
+                  acquired: bool=False):
+    """put dashboard before the deadline with scheduled or boto3 client
+
+    Args:
+        client (ScheduledClient or boto3.client): cloudwatch client
+        DashboardName (str): dashboard name
+        DashboardBody (str): DashboardBody
+        deadline (float, optional): time.monotonic() which the put must be sent before
+        acquired (bool, optional): a token is already taken by acquire()
+
+    Returns:
+        response of put_dashboard
+
+    Raises:
+        DeadlineExceeded: the deadline passed before the put was sent
+    """
+    if isinstance(client, ScheduledClient):
+        return client.put_dashboard(DashboardName=DashboardName, DashboardBody=DashboardBody,
+                                    deadline=deadline, acquired=acquired)
+    if deadline is not None and time.monotonic() > deadline:
+        raise DeadlineExceeded("put_dashboard")
+    return client.put_dashboard(DashboardName=DashboardName, DashboardBody=DashboardBody)